@@ -73,6 +73,14 @@ static const char *rsen_prefix[]= { "#RSEN:", NULL };
 // static GDBusClient *cardReader;
 static DBusConnection *connection;
 
+/*
+ * Bytes read off the SAP channels at once. A message can be as long as the
+ * MaxMsgSize negotiated by CONNECT_REQ (up to 64 KiB with extended APDUs);
+ * longer messages are passed on in several reads and put back together by
+ * the relay.
+ */
+#define SAP_BUF_SIZE 4096
+
 struct telit_data {
 	GAtChat *chat;		/* AT chat */
 	GAtChat *modem;		/* Data port */
@@ -84,6 +92,7 @@ struct telit_data {
 	GIOChannel *hw_io;
 	guint bt_watch;
 	guint hw_watch;
+	guint indication_watch;
 	ofono_bool_t bt_enabled;
 };
 
@@ -95,7 +104,7 @@ static void telit_debug(const char *str, void *user_data)
 }
 
 static void hex_print(const char *buf, const gsize bytes_read) {
-	char buf_str[300 * 3 + 1] = { 0 };
+	char buf_str[SAP_BUF_SIZE * 3 + 1] = { 0 };
 	char *endBuf = buf_str;
 	int i;
 	for (i = 0; i < bytes_read; i++) {
@@ -124,6 +133,11 @@ static void sap_close_io(struct ofono_modem *modem)
 
 	if (data->hw_watch > 0)
 		g_source_remove(data->hw_watch);
+
+	if (data->indication_watch > 0) {
+		g_dbus_remove_watch(connection, data->indication_watch);
+		data->indication_watch = 0;
+	}
 }
 
 static void bt_watch_remove(gpointer userdata)
@@ -145,9 +159,9 @@ static gboolean bt_event_cb(GIOChannel *bt_io, GIOCondition condition,
 	if (condition & G_IO_IN) {
 		GIOStatus status;
 		gsize bytes_read, bytes_written;
-		gchar buf[300];
+		gchar buf[SAP_BUF_SIZE];
 
-		status = g_io_channel_read_chars(bt_io, buf, 300,
+		status = g_io_channel_read_chars(bt_io, buf, SAP_BUF_SIZE,
 							&bytes_read, NULL);
 
 		if (bytes_read > 0) {
@@ -175,6 +189,37 @@ static gboolean bt_event_cb(GIOChannel *bt_io, GIOCondition condition,
 	return FALSE;
 }
 
+/*
+ * Write the byte array carried by msg, a processAPDU reply or an Indication
+ * signal, to the SAP channel.
+ */
+static GIOStatus write_sap_message(struct telit_data *data, DBusMessage *msg,
+							const char *source)
+{
+	DBusMessageIter iter, array;
+	const char *bytes = NULL;
+	int len = 0;
+	gsize bytes_written;
+	GIOStatus status = G_IO_STATUS_NORMAL;
+
+	if (!dbus_message_iter_init(msg, &iter) ||
+			dbus_message_iter_get_arg_type(&iter) != DBUS_TYPE_ARRAY ||
+			dbus_message_iter_get_element_type(&iter) != DBUS_TYPE_BYTE)
+		return status;
+
+	dbus_message_iter_recurse(&iter, &array);
+	dbus_message_iter_get_fixed_array(&array, &bytes, &len);
+
+	if (len > 0) {
+		status = g_io_channel_write_chars(data->hw_io, bytes,
+					len, &bytes_written, NULL);
+		DBG("%s <--- (read %d, wrote %d bytes to hw_io)", source, len, (int)bytes_written);
+		hex_print(bytes, len);
+	}
+
+	return status;
+}
+
 // Callback function meant to replace bt_event_cb
 // interacting with the smartcard over a generic DBUS connection rather than bluetooth
 static gboolean smartcard_cb (DBusPendingCall *call, gpointer userdata)
@@ -183,6 +228,7 @@ static gboolean smartcard_cb (DBusPendingCall *call, gpointer userdata)
 	struct telit_data *data = ofono_modem_get_data(modem);
 	DBusError derr;
 	DBusMessage *reply;
+	GIOStatus status;
 
 	// DBG("smartcard callback");
 
@@ -195,32 +241,7 @@ static gboolean smartcard_cb (DBusPendingCall *call, gpointer userdata)
 		return FALSE;
 	}
 
-	DBusMessageIter MsgIter;
-	dbus_message_iter_init(reply, &MsgIter);
-	int bytes_read;
-	gsize bytes_written;
-	gchar *smartcard_response;
-	if (dbus_message_iter_get_arg_type(&MsgIter) == DBUS_TYPE_ARRAY) {
-		// DBG("retrieving reply message as array");
-		if (dbus_message_iter_get_element_type(&MsgIter) == DBUS_TYPE_BYTE) {
-            // DBG("element type array, recursing");
-			DBusMessageIter arrayIter;
-			dbus_message_iter_recurse(&MsgIter, &arrayIter);
-			dbus_message_iter_get_fixed_array(&arrayIter, &smartcard_response, &bytes_read);
-		}
-        else {
-            // DBG("not an array - can't read");
-        }
-	}
-    
-    // hex_print(smartcard_response, bytes_read);
-    GIOStatus status;
-    if (bytes_read > 0) {
-		status = g_io_channel_write_chars(data->hw_io, smartcard_response,
-					bytes_read, &bytes_written, NULL);
-		DBG("smartcard event <--- (read %d, wrote %d bytes to hw_io)", (int)bytes_read, (int)bytes_written);
-		hex_print(smartcard_response, bytes_read);
-    }
+	status = write_sap_message(data, reply, "smartcard event");
 	if (status != G_IO_STATUS_NORMAL && status != G_IO_STATUS_AGAIN)
 		return FALSE;
 	// DBG("wrote %zu bytes back to hw_io", bytes_written);
@@ -229,6 +250,24 @@ static gboolean smartcard_cb (DBusPendingCall *call, gpointer userdata)
 	return TRUE;
 }
 
+/*
+ * STATUS_IND and DISCONNECT_IND pushed by the SIM server (e.g. when the card
+ * is removed or swapped) answer nothing the modem sent, so the relay emits
+ * them as an Indication signal. They are passed on to the modem as they
+ * arrive.
+ */
+static gboolean smartcard_indication(DBusConnection *conn, DBusMessage *msg,
+							void *user_data)
+{
+	struct ofono_modem *modem = user_data;
+	struct telit_data *data = ofono_modem_get_data(modem);
+
+	if (data->hw_io != NULL)
+		write_sap_message(data, msg, "smartcard indication");
+
+	return TRUE;
+}
+
 static void hw_watch_remove(gpointer userdata)
 {
 	struct ofono_modem *modem = userdata;
@@ -249,9 +288,9 @@ static gboolean hw_event_cb_smart(GIOChannel *hw_io, GIOCondition condition,
 	if (condition & G_IO_IN) {
 		GIOStatus status;
 		gsize bytes_read;
-		gchar buf[300] = "";
+		gchar buf[SAP_BUF_SIZE] = "";
 
-		status = g_io_channel_read_chars(hw_io, buf, 300,
+		status = g_io_channel_read_chars(hw_io, buf, SAP_BUF_SIZE,
 							&bytes_read, NULL);
 
 		if (bytes_read > 0) {
@@ -298,9 +337,9 @@ static gboolean hw_event_cb(GIOChannel *hw_io, GIOCondition condition,
 	if (condition & G_IO_IN) {
 		GIOStatus status;
 		gsize bytes_read, bytes_written;
-		gchar buf[300];
+		gchar buf[SAP_BUF_SIZE];
 
-		status = g_io_channel_read_chars(hw_io, buf, 300,
+		status = g_io_channel_read_chars(hw_io, buf, SAP_BUF_SIZE,
 							&bytes_read, NULL);
 
 		if (bytes_read > 0) {
@@ -675,7 +714,8 @@ static int telit_sap_enable_wifi(struct ofono_modem *modem,
 	DBG("Dbus connection to smartcard");
 	DBusError error;
 	dbus_error_init(&error);
-	connection = dbus_bus_get_private(DBUS_BUS_SYSTEM, &error);
+	// Private, but dispatched from the main loop so signals are delivered
+	connection = g_dbus_setup_private(DBUS_BUS_SYSTEM, NULL, &error);
 	if (!connection) {
 		DBG("dbus_bus_get failed");
 		if (dbus_error_is_set(&error)) {
@@ -690,6 +730,10 @@ static int telit_sap_enable_wifi(struct ofono_modem *modem,
 	// cardReader = g_dbus_client_new(connection, "org.smart_e.RSAP", "/");
 	// dbProxy = g_dbus_proxy_new(connection, "/RSAPServer","org.smart_e.RSAPServer");	
 
+	data->indication_watch = g_dbus_add_signal_watch(connection,
+				SMARTE_SERVICE, "/RSAPServer", SMARTE_INTERFACE,
+				"Indication", smartcard_indication, modem, NULL);
+
 	data->hw_watch = g_io_add_watch_full(data->hw_io, G_PRIORITY_HIGH,
 				G_IO_HUP | G_IO_ERR | G_IO_NVAL | G_IO_IN,
 				hw_event_cb_smart, modem, hw_watch_remove);
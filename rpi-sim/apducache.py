@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+
+"""
+APDU-aware caching of SIM file contents.
+
+Bringing up a modem mostly consists of SELECTs and READs of files whose
+contents never change while the SIM is in use (EF_ICCID, EF_DIR, EF_IMSI,
+EF_AD, ...). The cache follows the file selected by each SELECT, so a READ
+can be keyed by (selected path, APDU) and answered from memory.
+
+SELECTs of cacheable files are answered from memory too, without touching
+the card. They are kept as pending and replayed to the card just before the
+next command that does need it, so the card always sees the selection that
+command expects.
+
+The relay keeps one too, with a TTL, so that with a remote SIM server most
+of a modem's SIM initialisation is answered without a network round trip.
+It warms it up right after the ATR with the APDUs from warmupMF() and
+warmupADF(), which read the files a modem reads when it starts, and can read
+ahead the records of other files with RecordReadAhead.
+"""
+
+import time
+from collections import OrderedDict
+
+import metrics
+
+CACHE_LOOKUPS = metrics.counter('rsap_cache_lookups_total',
+                                "APDUs looked up in a file cache, by result",
+                                ('cache', 'result'))
+CACHE_HIT_RATIO = metrics.gauge('rsap_cache_hit_ratio',
+                                "Share of the APDUs looked up that a file cache answered",
+                                ('cache',))
+
+# Instruction bytes (ISO 7816-4, ETSI TS 102 221, GSM 11.11)
+INS_SELECT = 0xA4
+INS_READ_BINARY = 0xB0
+INS_READ_RECORD = 0xB2
+INS_GET_RESPONSE = 0xC0
+INS_UPDATE_BINARY = 0xD6
+INS_UPDATE_RECORD = 0xDC
+INS_APPEND_RECORD = 0xE2
+INS_INCREASE = 0x32
+INS_DEACTIVATE_FILE = 0x04
+INS_ACTIVATE_FILE = 0x44
+
+MODIFYING_INS = (INS_UPDATE_BINARY, INS_UPDATE_RECORD, INS_APPEND_RECORD,
+                 INS_INCREASE, INS_DEACTIVATE_FILE, INS_ACTIVATE_FILE)
+
+MF = 0x3F00
+CURRENT_ADF = 0x7FFF
+EF_ICCID = 0x2FE2
+
+# Elementary files whose contents do not change while the SIM is in use
+STATIC_FILES = {
+    0x2FE2: 'EF_ICCID',
+    0x2F00: 'EF_DIR',
+    0x2F05: 'EF_PL',
+    0x2F06: 'EF_ARR',
+    0x6F05: 'EF_LI',
+    0x6F06: 'EF_ARR',
+    0x6F07: 'EF_IMSI',
+    0x6F38: 'EF_UST',
+    0x6F3E: 'EF_GID1',
+    0x6F3F: 'EF_GID2',
+    0x6F46: 'EF_SPN',
+    0x6F56: 'EF_EST',
+    0x6FAD: 'EF_AD',
+    0x6FAE: 'EF_PHASE',
+    0x6FB7: 'EF_ECC',
+    0x6FC5: 'EF_PNN',
+    0x6FC6: 'EF_OPL',
+    0x6FCD: 'EF_SPDI',
+}
+
+# Files read ahead by the relay after the ATR, as (file ID, is record based)
+WARMUP_MF_FILES = [(0x2FE2, False), (0x2F05, False), (0x2F00, True)]
+WARMUP_ADF_FILES = [(0x6F07, False), (0x6FAD, False), (0x6F38, False),
+                    (0x6F46, False), (0x6F05, False), (0x6F3E, False),
+                    (0x6F3F, False), (0x6FB7, True)]
+# Records read ahead of each record based file
+WARMUP_RECORDS = 4
+
+USIM_RID = [0xA0, 0x00, 0x00, 0x00, 0x87, 0x10, 0x02]
+
+
+def isEF(fid):
+    return isinstance(fid, int) and (fid >> 8) in (0x2F, 0x4F, 0x6F)
+
+
+def currentDF(path):
+    if path and isEF(path[-1]):
+        return path[:-1]
+    return path
+
+
+def fileIDs(data):
+    return [(data[i] << 8) | data[i+1] for i in xrange(0, len(data) - 1, 2)]
+
+
+def selectTarget(path, apdu, adf=None):
+    ''' Path selected by a successful SELECT apdu, starting from path.
+    Paths are tuples of file IDs, with an application (ADF) given by its
+    AID as a string. Returns None if the result cannot be worked out. '''
+    if len(apdu) < 4:
+        return None
+    p1 = apdu[2]
+    data = apdu[5:5+apdu[4]] if len(apdu) > 4 else []
+    if p1 == 0x04:
+        return (bytes(bytearray(data)),)
+    fids = fileIDs(data)
+    if p1 == 0x00:
+        if not fids or fids[0] == MF:
+            return (MF,)
+        fid = fids[0]
+        if fid == CURRENT_ADF:
+            return (adf,) if adf else None
+        if path is None:
+            return None
+        df = currentDF(path)
+        if isEF(fid):
+            return df + (fid,)
+        if len(df) > 1 and df[-2] == fid:
+            return df[:-1]
+        return df + (fid,)
+    if p1 == 0x03:
+        if path is None:
+            return None
+        df = currentDF(path)
+        return df[:-1] if len(df) > 1 else df
+    if p1 == 0x08:
+        if fids and fids[0] == CURRENT_ADF:
+            return (adf,) + tuple(fids[1:]) if adf else None
+        return (MF,) + tuple(fids)
+    if p1 == 0x09:
+        if path is None:
+            return None
+        return currentDF(path) + tuple(fids)
+    return None
+
+
+def isAbsoluteSelect(apdu):
+    ''' Whether the result of the SELECT does not depend on what was
+    selected before it '''
+    p1 = apdu[2]
+    fids = fileIDs(apdu[5:5+apdu[4]] if len(apdu) > 4 else [])
+    if p1 == 0x04:
+        return True
+    if p1 == 0x08:
+        return not fids or fids[0] != CURRENT_ADF
+    return p1 == 0x00 and (not fids or fids[0] == MF)
+
+
+def isCacheablePath(path):
+    ''' Static EFs, and the MF/DFs/ADFs leading to them '''
+    if not path:
+        return False
+    return path[-1] in STATIC_FILES or not isEF(path[-1])
+
+
+def selectPath(path, cla=0x00):
+    ''' SELECTs putting the card back on path, or None if that cannot be
+    done. A GSM SIM (class A0) is walked down one file at a time, a UICC
+    selects the application or the path from the MF without asking for data
+    back. '''
+    if not path:
+        return None
+    if cla & 0xF0 == 0xA0:
+        if path[0] != MF:
+            return None
+        return [[0xA0, INS_SELECT, 0x00, 0x00, 0x02, fid >> 8, fid & 0xFF] for fid in path]
+    data = []
+    for fid in path[1:]:
+        data += [fid >> 8, fid & 0xFF]
+    if isinstance(path[0], str):
+        aid = list(bytearray(path[0]))
+        apdus = [[0x00, INS_SELECT, 0x04, 0x0C, len(aid)] + aid]
+        if data:
+            apdus.append([0x00, INS_SELECT, 0x09, 0x0C, len(data)] + data)
+        return apdus
+    if path[0] != MF:
+        return None
+    if data:
+        return [[0x00, INS_SELECT, 0x08, 0x0C, len(data)] + data]
+    return [[0x00, INS_SELECT, 0x00, 0x0C, 0x02, MF >> 8, MF & 0xFF]]
+
+
+def isExtended(apdu):
+    ''' Whether apdu has extended length fields: a zero byte where a short
+    APDU has Lc or Le, followed by at least two more '''
+    return len(apdu) >= 7 and apdu[4] == 0
+
+
+def responseLength(apdu):
+    ''' Le of apdu, 0 if it has none, and 256 or 65536 when it asks for as
+    much as there is '''
+    if isExtended(apdu):
+        lc = (apdu[5] << 8) | apdu[6]
+        if len(apdu) == 7:
+            # No command data, only Le
+            return lc or 0x10000
+        if len(apdu) == 7 + lc + 2:
+            return ((apdu[-2] << 8) | apdu[-1]) or 0x10000
+        return 0
+    if len(apdu) == 5:
+        return apdu[4] or 0x100
+    if len(apdu) > 5 and len(apdu) == 6 + apdu[4]:
+        return apdu[-1] or 0x100
+    return 0
+
+
+def limitResponseLength(apdu, limit):
+    ''' apdu asking for at most limit bytes of data: an extended Le larger
+    than that is brought down to it, as the response would not fit in what
+    the client can take '''
+    if not isExtended(apdu) or responseLength(apdu) <= limit:
+        return apdu
+    apdu = bytearray(apdu)
+    apdu[-2:] = [limit >> 8, limit & 0xFF]
+    return apdu
+
+
+def isSuccess(response):
+    return len(response) >= 2 and response[-2] in (0x90, 0x9F, 0x61)
+
+
+def warmupReads(fid, records):
+    if records:
+        return [[0x00, INS_READ_RECORD, n, 0x04, 0x00] for n in xrange(1, WARMUP_RECORDS + 1)]
+    return [[0x00, INS_READ_BINARY, 0x00, 0x00, 0x00]]
+
+
+def warmupMF():
+    ''' APDUs reading the static files under the MF of a UICC. Reads ask
+    for the whole file or record (Le = 0). '''
+    apdus = []
+    for fid, records in WARMUP_MF_FILES:
+        apdus.append([0x00, INS_SELECT, 0x08, 0x04, 0x02, fid >> 8, fid & 0xFF])
+        apdus.extend(warmupReads(fid, records))
+    return apdus
+
+
+def warmupADF(aid):
+    ''' APDUs reading the static files of the application aid '''
+    aid = list(bytearray(aid))
+    apdus = [[0x00, INS_SELECT, 0x04, 0x04, len(aid)] + aid]
+    for fid, records in WARMUP_ADF_FILES:
+        apdus.append([0x00, INS_SELECT, 0x00, 0x04, 0x02, fid >> 8, fid & 0xFF])
+        apdus.extend(warmupReads(fid, records))
+    return apdus
+
+
+def applicationID(record):
+    ''' AID from an EF_DIR record (61 len 4F len AID ...), or None '''
+    record = list(bytearray(record))
+    if len(record) < 4 or record[0] != 0x61 or record[2] != 0x4F:
+        return None
+    aid = record[4:4+record[3]]
+    return bytes(bytearray(aid)) if len(aid) == record[3] else None
+
+
+def recordCount(fcp):
+    ''' Number of records of a record based EF, from the FCP template a
+    SELECT returned (62 len ... 82 len descriptor coding reclen(2) count),
+    or None '''
+    fcp = list(bytearray(fcp))
+    if len(fcp) < 2 or fcp[0] != 0x62:
+        return None
+    offset = 3 if fcp[1] == 0x81 else 2
+    while offset + 2 <= len(fcp):
+        tag, length = fcp[offset], fcp[offset+1]
+        if tag == 0x82:
+            if length >= 5 and offset + 7 <= len(fcp):
+                return fcp[offset+6]
+            return None
+        offset += 2 + length
+    return None
+
+
+class RecordReadAhead:
+    ''' Records read ahead of a run of READ RECORDs in absolute mode, as a
+    modem makes when it loads the phonebook or the SMS. A read that misses
+    is sent along with reads of the next count - 1 records (up to the last
+    one, if the SELECT said how many there are), whose responses are kept
+    with store() to answer the reads that follow.
+
+    Call observe() with every APDU: anything but another absolute READ
+    RECORD drops whatever was read ahead, so nothing outlives a change of
+    file or an update. Responses to reads sent before that are ignored,
+    going by the generation they were sent in. '''
+    def __init__(self, count):
+        self.count = count
+        self.records = {}
+        self.total = None
+        self.generation = 0
+
+    def reset(self):
+        self.records.clear()
+        self.generation += 1
+        self.total = None
+
+    def observe(self, apdu):
+        apdu = list(bytearray(apdu))
+        if len(apdu) >= 4 and apdu[1] == INS_READ_RECORD and apdu[3] == 0x04:
+            return
+        if len(apdu) >= 2 and apdu[1] == INS_SELECT:
+            self.reset()
+            return
+        self.records.clear()
+        self.generation += 1
+
+    def selected(self, response):
+        ''' The card's response to the last SELECT '''
+        response = list(bytearray(response))
+        self.total = recordCount(response[:-2]) if isSuccess(response) else None
+
+    @staticmethod
+    def key(apdu):
+        return apdu[0], apdu[2], apdu[4] if len(apdu) > 4 else 0
+
+    def lookup(self, apdu):
+        ''' Response read ahead for apdu, or None '''
+        apdu = list(bytearray(apdu))
+        if len(apdu) < 4 or apdu[1] != INS_READ_RECORD or apdu[3] != 0x04:
+            return None
+        return self.records.pop(self.key(apdu), None)
+
+    def following(self, apdu):
+        ''' READ RECORDs to send along with apdu, an absolute READ RECORD
+        that missed '''
+        apdu = list(bytearray(apdu))
+        if len(apdu) < 4 or apdu[1] != INS_READ_RECORD or apdu[3] != 0x04:
+            return []
+        cla, record, le = self.key(apdu)
+        last = min(record + self.count - 1, 0xFF)
+        if self.total is not None:
+            last = min(last, self.total)
+        return [[cla, INS_READ_RECORD, n, 0x04, le] for n in xrange(record + 1, last + 1)]
+
+    def store(self, generation, apdu, response):
+        if generation == self.generation:
+            self.records[self.key(list(bytearray(apdu)))] = list(bytearray(response))
+
+
+class FileCache:
+    ''' Cache of SELECT and READ responses, following the file selected on
+    the card so reads can be keyed by the path they were made on.
+
+    It does not talk to the card itself, which lets it sit in front of a
+    card that is answered asynchronously too: lookup(apdu) returns
+    (response, token), where response is the cached response as a list of
+    bytes followed by SW1 SW2, or None when the APDU has to go to the card.
+    Before sending it, the SELECTs from takePendingSelects() have to be sent
+    first, and the card's response handed back with update(token, response).
+
+    Entries are dropped once older than ttl seconds (never if ttl is None),
+    and the least recently used ones once there are more than maxEntries. '''
+    def __init__(self, maxEntries=512, ttl=None):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.reset()
+
+    def reset(self):
+        ''' Forget the selection state and all cached files, e.g. after a
+        different card being inserted '''
+        self.responses.clear()
+        self.resetSelection()
+
+    def resetSelection(self, path=None):
+        ''' The card's selection was changed behind our back, e.g. by a
+        reset (which selects the MF) '''
+        self.path = path
+        self.adf = None
+        self.pendingSelects = []
+
+    def invalidate(self):
+        ''' Drop cached contents of the currently selected file '''
+        if self.path is None or not isEF(self.path[-1]):
+            self.responses.clear()
+            return
+        for key in [k for k in self.responses if k[0] == self.path]:
+            del self.responses[key]
+
+    def get(self, key, now=None):
+        entry = self.responses.pop(key, None)
+        if entry is None:
+            return None
+        value, stored = entry
+        if self.ttl is not None:
+            if now is None:
+                now = time.time()
+            if now - stored > self.ttl:
+                return None
+        self.responses[key] = entry
+        return value
+
+    def put(self, key, value, now=None):
+        if now is None:
+            now = time.time()
+        self.responses.pop(key, None)
+        self.responses[key] = (value, now)
+        while len(self.responses) > self.maxEntries:
+            self.responses.popitem(last=False)
+
+    def iccid(self, now=None):
+        ''' ICCID of the card, if EF_ICCID was read into the cache and has
+        not expired '''
+        cached = self.get(((MF, EF_ICCID), INS_READ_BINARY), now)
+        if cached is None or not cached[0]:
+            return None
+        # BCD with swapped nibbles, padded with F
+        return ''.join(['%X%X' % (b & 0x0F, b >> 4) for b in cached[0]]).rstrip('F')
+
+    def exportMetrics(self, name):
+        ''' Publish the hit and miss counts under the label cache=name '''
+        CACHE_LOOKUPS.labels(name, 'hit').setFunction(lambda: self.hits)
+        CACHE_LOOKUPS.labels(name, 'miss').setFunction(lambda: self.misses)
+        CACHE_HIT_RATIO.labels(name).setFunction(lambda: metrics.ratio(self.hits, self.misses))
+
+    def takePendingSelects(self):
+        ''' SELECTs answered from the cache that the card has not seen yet,
+        to be sent ahead of the next APDU forwarded to it '''
+        pending, self.pendingSelects = self.pendingSelects, []
+        return pending
+
+    def setPath(self, path):
+        self.path = path
+        if path and isinstance(path[0], str):
+            self.adf = path[0]
+
+    def lookup(self, apdu, now=None):
+        apdu = list(bytearray(apdu))
+        if len(apdu) < 4:
+            return None, None
+        ins = apdu[1]
+        if ins == INS_SELECT:
+            return self.lookupSelect(apdu, now)
+        if ins in (INS_READ_BINARY, INS_READ_RECORD):
+            return self.lookupRead(apdu, now)
+        if ins in MODIFYING_INS:
+            self.invalidate()
+        return None, None
+
+    def lookupSelect(self, apdu, now):
+        target = selectTarget(self.path, apdu, self.adf)
+        if target is None or not isCacheablePath(target):
+            self.setPath(target)
+            return None, (INS_SELECT, None)
+        # The response only depends on the file selected and on what P2
+        # asks to be returned about it
+        key = (target, apdu[0], apdu[3])
+        cached = self.get(key, now)
+        if cached is not None:
+            self.hits += 1
+            if isAbsoluteSelect(apdu):
+                self.pendingSelects = []
+            self.pendingSelects.append(apdu)
+            self.setPath(target)
+            return list(cached), None
+        self.misses += 1
+        # Assume it works, so APDUs sent before the response arrives are
+        # looked up on the right path. update() undoes this if it fails.
+        self.setPath(target)
+        return None, (INS_SELECT, key)
+
+    def lookupRead(self, apdu, now):
+        ins, p1, p2 = apdu[1], apdu[2], apdu[3]
+        le = responseLength(apdu)
+        # As much as there is: the whole record, or the whole file for an
+        # extended read, but no more than 256 bytes of it for a short one
+        asksAll = le == (0x10000 if isExtended(apdu) else 0x100)
+        if ins == INS_READ_BINARY:
+            # Short file identifier in P1 implicitly selects another file
+            implicitSelect = p1 & 0x80
+            absolute = True
+        else:
+            implicitSelect = p2 >> 3
+            # Only absolute record numbers are independent of the
+            # record pointer
+            absolute = (p2 & 0x07) == 0x04
+        if implicitSelect:
+            self.path = None
+            return None, None
+        if self.path is None or self.path[-1] not in STATIC_FILES or not absolute:
+            return None, None
+        if ins == INS_READ_BINARY:
+            # Binary contents are kept from offset 0 on, so any read that
+            # falls inside what has been read before can be answered
+            offset = (p1 << 8) | p2
+            key = (self.path, ins)
+            cached = self.get(key, now)
+            if cached is not None:
+                data, whole = cached
+                if le and offset + le <= len(data):
+                    self.hits += 1
+                    return data[offset:offset+le] + [0x90, 0x00], None
+                if asksAll and offset == 0 and whole:
+                    self.hits += 1
+                    return data + [0x90, 0x00], None
+            self.misses += 1
+            return None, (ins, key, offset, le if asksAll else 0)
+        key = (self.path, ins, p1)
+        cached = self.get(key, now)
+        if cached is not None and (asksAll or le == len(cached)):
+            self.hits += 1
+            return cached + [0x90, 0x00], None
+        self.misses += 1
+        return None, (ins, key, p1, le)
+
+    def update(self, token, response, now=None):
+        if token is None:
+            return
+        response = list(bytearray(response))
+        ins, key = token[0], token[1]
+        if ins == INS_SELECT:
+            if not isSuccess(response):
+                # The card keeps its previous selection, which we no
+                # longer know
+                self.path = None
+            elif key is not None:
+                self.put(key, response, now)
+                if key[2] != 0x0C and response[-2:] == [0x90, 0x00]:
+                    # Selecting it without asking for data is known to work
+                    self.put(key[:2] + (0x0C,), [0x90, 0x00], now)
+            return
+        if response[-2:] != [0x90, 0x00]:
+            return
+        data = response[:-2]
+        if ins == INS_READ_BINARY:
+            offset, asked = token[2], token[3]
+            if offset == 0:
+                cached = self.get(key, now)
+                if cached is None or len(cached[0]) <= len(data):
+                    # Fewer bytes than a read of as much as there is asked
+                    # for, so there are no more
+                    self.put(key, (data, len(data) < asked), now)
+            return
+        self.put(key, data, now)
+
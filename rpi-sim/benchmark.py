@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the SIM server, the command relay and the D-Bus service, runnable
+on a plain Linux box: the PC/SC reader is replaced by a SimulatedCard and the
+network by a CURVE authenticated ZMQ link over loopback, optionally made as
+slow as a real one with --rtt.
+
+A trace of RSAP messages is replayed, one message at a time as ofono sends
+them, against one or more targets:
+
+    server          simserver's SIM farm, from a DEALER client
+    relay           dbusrelaynet.Server in front of that farm, called the
+                    way ofono calls it over D-Bus
+    dbus-service    dbus-service.Server, called directly
+
+and the latency of every message, the throughput, the CPU time per APDU and
+the number of APDUs that reached the card are reported.
+
+A trace file holds one RSAP message (or fragment of one) per line in hex.
+Anything up to a '>' is ignored, so the INCOMING lines logged by the relay can
+be replayed as they are. Blank lines and lines starting with # are skipped.
+A capture made with --trace can be replayed too, its received fragments in
+order. Without a trace file, a SIM initialisation as done by ofono is replayed.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import argparse
+import heapq
+
+import zmq
+import zmq.auth
+
+from rsap import RSAPMessageProtocol, buildMessage, messageName, parameterName
+import transport
+import tracing
+import metrics
+
+READER = 'Simulated reader'
+
+PHONEBOOK_RECORDS = 10
+# PLMN/access technology entries of 5 bytes in EF_OPLMNwACT
+OPLMN_ENTRIES = 200
+
+USIM_AID = [0xA0, 0x00, 0x00, 0x00, 0x87, 0x10, 0x02, 0xFF,
+            0xFF, 0xFF, 0xFF, 0x89, 0x03, 0x02, 0x00, 0x00]
+
+
+class SimulatedCard:
+    ''' Stands in for a pyscard connection to a T=0 UICC that only takes
+    short APDUs. It answers SELECTs with 61xx and the FCP on GET RESPONSE,
+    READ RECORD with 6Cxx when Le is not the record's length, and READ
+    BINARY with at most 256 bytes, 6282 when the file ends before Le bytes
+    and 6B00 for an offset past its end. It can be powered off and on and
+    reset, which selects the MF, and takes delay seconds per APDU, like a
+    real card would. '''
+    def __init__(self, delay=0.0, iccid='8944000000000000001'):
+        self.delay = delay
+        self.transmits = 0
+        digits = iccid + 'F' * (20 - len(iccid))
+        efDir = [0x61, len(USIM_AID) + 2, 0x4F, len(USIM_AID)] + USIM_AID
+        self.binary = {
+            0x2FE2: [int(digits[i+1] + digits[i], 16) for i in xrange(0, 20, 2)],
+            0x2F05: [0x65, 0x6E, 0xFF, 0xFF],
+            0x6F07: [0x08, 0x09, 0x10, 0x10, 0x32, 0x54, 0x76, 0x98, 0x10],
+            0x6FAD: [0x00, 0x00, 0x00, 0x02],
+            0x6F38: [0x9E, 0x6B, 0x1D, 0x9C, 0x23, 0x00, 0x00, 0x00],
+            0x6F46: [0x01] + [0x41] * 6 + [0xFF] * 9,
+            0x6F05: [0x65, 0x6E, 0xFF, 0xFF],
+            # EF_OPLMNwACT, larger than one short READ BINARY
+            0x6F61: [b for n in xrange(OPLMN_ENTRIES) for b in (0x32, 0xF4, n & 0xFF, 0xC0, 0x80)],
+        }
+        self.records = {
+            0x2F00: [efDir + [0xFF] * (0x26 - len(efDir))],
+            0x6FB7: [[0x11, 0xF2, 0xFF, 0x00] + [0xFF] * 17] * 2,
+            # EF_ADN, a small phonebook
+            0x6F3A: [[0x41 + n] + [0xFF] * 13 + [0x03, 0x81, 0x21, 0x43] + [0xFF] * 10
+                     for n in xrange(PHONEBOOK_RECORDS)],
+        }
+        self.selected = None
+        self.response = []
+        self.powered = True
+
+    def addObserver(self, observer):
+        pass
+
+    def setErrorCheckingChain(self, chain):
+        pass
+
+    def connect(self, *args, **kwargs):
+        if not self.powered:
+            self.reconnect()
+
+    def disconnect(self):
+        self.powered = False
+
+    def reconnect(self, *args, **kwargs):
+        ''' Reset, leaving the MF selected '''
+        self.powered = True
+        self.selected = None
+        self.response = []
+
+    def getReader(self):
+        return READER
+
+    def getATR(self):
+        return [0x3B, 0x9F, 0x96, 0x80, 0x1F, 0xC7, 0x80, 0x31, 0xE0, 0x73]
+
+    def fcp(self, fid):
+        records = self.records.get(fid)
+        if records:
+            size = len(records[0]) * len(records)
+            descriptor = [0x82, 0x05, 0x42, 0x21, 0x00, len(records[0]), len(records)]
+        else:
+            size = len(self.binary.get(fid, []))
+            descriptor = [0x82, 0x02, 0x41, 0x21]
+        body = descriptor + [0x83, 0x02, fid >> 8, fid & 0xFF,
+                             0x80, 0x02, size >> 8, size & 0xFF] + [0x00] * 10
+        return [0x62, len(body)] + body
+
+    def transmit(self, apdu, protocol=None):
+        if not self.powered:
+            from smartcard.Exceptions import CardConnectionException
+            raise CardConnectionException('Card is unpowered')
+        self.transmits += 1
+        if self.delay:
+            time.sleep(self.delay)
+        ins, p1, p2 = apdu[1], apdu[2], apdu[3]
+        le = apdu[4] if len(apdu) > 4 else 0
+        if ins == 0xA4:
+            data = apdu[5:5+apdu[4]]
+            if p1 == 0x04:
+                self.selected = None
+            elif len(data) >= 2:
+                self.selected = (data[-2] << 8) | data[-1]
+            if p2 == 0x0C:
+                return [], 0x90, 0x00
+            self.response = self.fcp(self.selected or 0x7FFF)
+            return [], 0x61, len(self.response)
+        if ins == 0xC0:
+            response, self.response = self.response[:le], []
+            return response, 0x90, 0x00
+        if ins == 0xB0:
+            data = self.binary.get(self.selected)
+            if len(apdu) != 5:
+                # Neither short Le alone nor anything extended
+                return [], 0x67, 0x00
+            if data is None:
+                return [], 0x69, 0x86
+            if p1 & 0x80:
+                # Short file identifiers are not simulated
+                return [], 0x6A, 0x81
+            offset = (p1 << 8) | p2
+            if offset > len(data):
+                return [], 0x6B, 0x00
+            data = data[offset:offset + (le or 0x100)]
+            if le and len(data) < le:
+                return data, 0x62, 0x82
+            return data, 0x90, 0x00
+        if ins == 0xB2:
+            records = self.records.get(self.selected, [])
+            if not 0 < p1 <= len(records):
+                return [], 0x6A, 0x83
+            if le != len(records[p1-1]):
+                return [], 0x6C, len(records[p1-1])
+            return records[p1-1], 0x90, 0x00
+        if ins == 0x88:
+            # AUTHENTICATE / RUN GSM ALGORITHM
+            self.response = [0xDB, 0x08] + [0x5A] * 8 + [0x10] + [0xA5] * 16
+            return [], 0x61, len(self.response)
+        return [], 0x90, 0x00
+
+
+class SimulatedCardService:
+    def __init__(self, delay=0.0):
+        self.connection = SimulatedCard(delay)
+
+
+def defaultTrace():
+    ''' CONNECT_REQ, TRANSFER_ATR_REQ and the APDUs of a SIM initialisation,
+    loading the phonebook and the operator PLMN list and one
+    authentication, as RSAP messages '''
+    rsap = RSAPMessageProtocol()
+    apdus = [
+        [0x00, 0xA4, 0x08, 0x04, 0x02, 0x2F, 0xE2], [0x00, 0xA4, 0x08, 0x0C, 0x02, 0x2F, 0xE2],
+        [0x00, 0xB0, 0x00, 0x00, 0x0A],
+        [0x00, 0xA4, 0x08, 0x04, 0x02, 0x2F, 0x00], [0x00, 0xA4, 0x08, 0x0C, 0x02, 0x2F, 0x00],
+        [0x00, 0xB2, 0x01, 0x04, 0x26],
+        [0x00, 0xA4, 0x08, 0x04, 0x02, 0x2F, 0x05], [0x00, 0xB0, 0x00, 0x00, 0x04],
+        [0x00, 0xA4, 0x04, 0x0C, len(USIM_AID)] + USIM_AID,
+        [0x00, 0xA4, 0x00, 0x04, 0x02, 0x6F, 0xB7], [0x00, 0xA4, 0x00, 0x0C, 0x02, 0x6F, 0xB7],
+        [0x00, 0xB2, 0x01, 0x04, 0x15], [0x00, 0xB2, 0x02, 0x04, 0x15],
+        [0x00, 0xA4, 0x00, 0x04, 0x02, 0x6F, 0x05], [0x00, 0xB0, 0x00, 0x00, 0x04],
+        [0x00, 0xA4, 0x00, 0x04, 0x02, 0x6F, 0xAD], [0x00, 0xB0, 0x00, 0x00, 0x04],
+        [0x00, 0xA4, 0x00, 0x04, 0x02, 0x6F, 0x07], [0x00, 0xB0, 0x00, 0x00, 0x09],
+        [0x00, 0xA4, 0x00, 0x04, 0x02, 0x6F, 0x38], [0x00, 0xB0, 0x00, 0x00, 0x08],
+        [0x00, 0xA4, 0x00, 0x04, 0x02, 0x6F, 0x46], [0x00, 0xB0, 0x00, 0x00, 0x10],
+        # All of a file larger than 256 bytes, with an extended Le
+        [0x00, 0xA4, 0x00, 0x0C, 0x02, 0x6F, 0x61], [0x00, 0xB0, 0x00, 0x00, 0x00, 0x00, 0x00],
+        [0x00, 0xA4, 0x00, 0x04, 0x02, 0x6F, 0x3A],
+    ] + [[0x00, 0xB2, n, 0x04, 0x1C] for n in xrange(1, PHONEBOOK_RECORDS + 1)] + [
+        [0x00, 0x88, 0x00, 0x81, 0x22, 0x10] + [0x01] * 16 + [0x10] + [0x02] * 16,
+    ]
+    trace = [bytes(buildMessage(messageName['CONNECT_REQ'],
+                                [(parameterName['MaxMsgSize'], [0x10, 0x00])])),
+             bytes(buildMessage(messageName['TRANSFER_ATR_REQ'], []))]
+    trace += [bytes(rsap.generateTRANSFER_APDU_REQ(apdu)) for apdu in apdus]
+    return trace
+
+
+def loadTrace(path):
+    ''' Messages from a capture (what was received), or from a text file
+    with one hex message per line '''
+    if tracing.isTrace(path):
+        reader = tracing.TraceReader(path)
+        trace = [bytes(record.data) for record in reader.records(direction=tracing.IN)]
+        reader.close()
+        return trace
+    trace = []
+    for line in open(path):
+        line = line.split('>')[-1].strip()
+        if line and not line.startswith('#'):
+            trace.append(bytes(bytearray(int(b, 16) for b in line.split())))
+    return trace
+
+
+def countAPDUs(trace):
+    return len([m for m in trace if bytearray(m[:1]) == bytearray([messageName['TRANSFER_APDU_REQ']])])
+
+
+def curveClient(ctx, base_dir, address, socketType=zmq.DEALER, identity=None):
+    client = ctx.socket(socketType)
+    if identity:
+        client.identity = identity
+    client.curve_publickey, client.curve_secretkey = zmq.auth.load_certificate(
+        os.path.join(base_dir, 'private_keys', 'client.key_secret'))
+    client.curve_serverkey, _ = zmq.auth.load_certificate(
+        os.path.join(base_dir, 'public_keys', 'server.key'))
+    client.connect(address)
+    return client
+
+
+class DelayLine:
+    ''' Stands between clients and the farm, holding every message for
+    half of rtt seconds each way, like a network link would. Each client
+    gets a connection of its own to the farm, and both sides use CURVE. '''
+    def __init__(self, base_dir, address, rtt):
+        import simserver
+        self.ctx = zmq.Context()
+        self.base_dir = base_dir
+        self.target = address
+        self.frontend, self.auth = simserver.bindFrontend(self.ctx, 'tcp://127.0.0.1:*', base_dir)
+        self.address = self.frontend.getsockopt(zmq.LAST_ENDPOINT)
+        self.delay = rtt / 2.0
+        thread = threading.Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        # Connection to the farm for each client identity, and back
+        backends = {}
+        identities = {}
+        # (time due, arrival order, socket to send on, frames)
+        queue = []
+        arrivals = 0
+        while True:
+            timeout = None
+            if queue:
+                timeout = max(0, (queue[0][0] - time.time()) * 1000)
+            for socket, event in poller.poll(timeout):
+                frames = socket.recv_multipart()
+                if socket is self.frontend:
+                    identity, frames = frames[0], frames[1:]
+                    destination = backends.get(identity)
+                    if destination is None:
+                        destination = backends[identity] = curveClient(
+                            self.ctx, self.base_dir, self.target, identity=identity)
+                        identities[destination] = identity
+                        poller.register(destination, zmq.POLLIN)
+                else:
+                    frames, destination = [identities[socket]] + frames, self.frontend
+                arrivals += 1
+                heapq.heappush(queue, (time.time() + self.delay, arrivals, destination, frames))
+            while queue and queue[0][0] <= time.time():
+                _, _, destination, frames = heapq.heappop(queue)
+                destination.send_multipart(frames)
+
+
+class Farm:
+    ''' simserver's SIM farm with one simulated card, listening on
+    loopback, rtt seconds away '''
+    # Farms are kept until exit, their authenticator stops once collected
+    running = []
+
+    def __init__(self, base_dir, cache=True, delay=0.0, rtt=0.0, trace=None):
+        Farm.running.append(self)
+        import simserver
+        self.ctx = zmq.Context()
+        self.frontend, self.auth = simserver.bindFrontend(self.ctx, 'tcp://127.0.0.1:*', base_dir)
+        self.address = self.frontend.getsockopt(zmq.LAST_ENDPOINT)
+        self.cardservice = SimulatedCardService(delay)
+        self.farm = simserver.SimFarm(self.ctx, self.frontend, [READER], cache=cache,
+                                      cardservices={READER: self.cardservice}, trace=trace)
+        thread = threading.Thread(target=self.farm.run)
+        thread.setDaemon(True)
+        thread.start()
+        if rtt:
+            self.address = DelayLine(base_dir, self.address, rtt).address
+
+    def card(self):
+        return self.cardservice.connection
+
+
+def startFarm(options, base_dir):
+    return Farm(base_dir, not options.no_cache, options.card_delay, options.rtt, options.sink)
+
+
+def serverTarget(options, base_dir):
+    farm = startFarm(options, base_dir)
+    client = curveClient(zmq.Context.instance(), base_dir, farm.address)
+    state = {'seq': 0}
+
+    def send(message):
+        state['seq'] += 1
+        client.send_multipart([b''] + transport.encode(message, state['seq']))
+        return transport.decode(client.recv_multipart()[1:])[0]
+    return send, farm.card()
+
+
+def relayTarget(options, base_dir):
+    import dbusrelaynet
+    farm = startFarm(options, base_dir)
+    relay = dbusrelaynet.Server(cache=not options.no_cache, warmup=not options.no_cache,
+                                batch=options.batch, address=farm.address, base_dir=base_dir, export=False,
+                                trace=options.sink)
+
+    def send(message):
+        replies = []
+        relay.processAPDU(bytearray(message), replies.append, None)
+        # Stands in for the GLib main loop watching the socket
+        while not replies:
+            relay.client.poll(1000)
+            relay.onServerReadable()
+        return replies[0]
+    return send, farm.card()
+
+
+def dbusServiceTarget(options, base_dir):
+    import imp
+    module = imp.load_source('dbus_service', os.path.join(os.path.dirname(__file__) or '.',
+                                                          'dbus-service.py'))
+    cardservice = SimulatedCardService(options.card_delay)
+    service = module.Server(cardservice=cardservice, export=False, trace=options.sink)
+    processor = threading.Thread(target=service.apduProcessor)
+    processor.setDaemon(True)
+    processor.start()
+
+    def send(message):
+        return service.processAPDU(message, sender=':benchmark')
+    return send, cardservice.connection
+
+
+# Each target returns (send(message), card). send() gets the reply to one
+# message across, card is the SimulatedCard behind it.
+TARGETS = [
+    ('server', serverTarget),
+    ('relay', relayTarget),
+    ('dbus-service', dbusServiceTarget),
+]
+
+
+def percentile(values, p):
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def replay(send, trace, repeat):
+    ''' Returns (latencies, wall clock time, CPU time) '''
+    latencies = []
+    start, cpuStart = time.time(), sum(os.times()[:2])
+    for i in xrange(repeat):
+        for message in trace:
+            sent = time.time()
+            send(message)
+            latencies.append(time.time() - sent)
+    return latencies, time.time() - start, sum(os.times()[:2]) - cpuStart
+
+
+def report(name, trace, repeat, latencies, wall, cpu, transmits):
+    latencies = sorted(latencies)
+    apdus = countAPDUs(trace) * repeat
+    print "%-13s %6d msgs %9.1f msg/s  p50 %7.3f  p90 %7.3f  p99 %7.3f  max %7.3f ms" \
+        "  %7.1f us CPU/APDU  %5d card APDUs" % (
+            name, len(latencies), len(latencies) / wall,
+            percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000, latencies[-1] * 1000,
+            cpu / max(apdus, 1) * 1e6, transmits)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an RSAP trace against the servers with a simulated card")
+    parser.add_argument('targets', nargs='*', default=[name for name, _ in TARGETS],
+                        help="any of %s (default: all)" % ', '.join(name for name, _ in TARGETS))
+    parser.add_argument('--replay', metavar='FILE', help="trace to replay, one hex message per line")
+    parser.add_argument('--repeat', type=int, default=20, help="times to replay the trace")
+    parser.add_argument('--card-delay', type=float, default=0.005,
+                        help="seconds the simulated card takes per APDU")
+    parser.add_argument('--rtt', type=float, default=0.0,
+                        help="seconds of network round trip added between client and server")
+    parser.add_argument('--no-cache', action='store_true', help="disable the response caches")
+    parser.add_argument('--batch', type=int, default=0, metavar='N',
+                        help="let the relay batch up to N messages per request")
+    tracing.addArguments(parser)
+    metrics.addArguments(parser)
+    options = parser.parse_args()
+    options.sink = tracing.configure(options)
+    endpoint = metrics.configure(options)
+    if endpoint is not None:
+        endpoint.start()
+
+    trace = loadTrace(options.replay) if options.replay else defaultTrace()
+    targets = dict(TARGETS)
+    for name in options.targets:
+        if name not in targets:
+            parser.error("unknown target %s" % name)
+
+    from generate_certificates import generate_certificates
+    base_dir = tempfile.mkdtemp(prefix='rsap-benchmark-')
+    try:
+        generate_certificates(base_dir)
+        for name in options.targets:
+            send, card = targets[name](options, base_dir)
+            # Not counting the ones made while starting up
+            transmits = card.transmits
+            latencies, wall, cpu = replay(send, trace, options.repeat)
+            report(name, trace, options.repeat, latencies, wall, cpu,
+                   card.transmits - transmits)
+    finally:
+        shutil.rmtree(base_dir)
+        if options.sink is not None:
+            options.sink.close()
+
+
+if __name__ == '__main__':
+    if zmq.zmq_version_info() < (4,0):
+        raise RuntimeError("Security is not supported in libzmq version < 4.0. libzmq version {0}".format(zmq.zmq_version()))
+    main()
+    # The servers' threads block on their sockets for good, and terminating
+    # their contexts at exit would wait for them
+    sys.stdout.flush()
+    os._exit(0)
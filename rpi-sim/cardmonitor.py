@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+Card and reader events for the SIM server.
+
+pyscard's CardMonitor and ReaderMonitor call their observers from threads of
+their own. Monitor passes what they see on to the server's poll loop, as
+[event, reader name] messages on an inproc PUSH socket, so that cards coming
+and going are handled there along with everything else:
+
+    inserted    a card was put in the reader
+    removed     the card was taken out
+    attached    a reader was plugged in
+    detached    a reader was unplugged
+
+Observers are told about the readers and cards already there when they are
+added, so the first events repeat what the server found when it started.
+"""
+
+import threading
+
+import zmq
+from smartcard.CardMonitoring import CardMonitor, CardObserver
+from smartcard.ReaderMonitoring import ReaderMonitor, ReaderObserver
+
+INSERTED = b'inserted'
+REMOVED = b'removed'
+ATTACHED = b'attached'
+DETACHED = b'detached'
+
+
+class Monitor:
+    def __init__(self, ctx, address):
+        # The monitors each notify from their own thread
+        self.lock = threading.Lock()
+        self.socket = ctx.socket(zmq.PUSH)
+        self.socket.connect(address)
+        self.readers = ReaderEvents(self)
+        self.cards = CardEvents(self)
+
+    def start(self):
+        ReaderMonitor().addObserver(self.readers)
+        CardMonitor().addObserver(self.cards)
+
+    def stop(self):
+        CardMonitor().deleteObserver(self.cards)
+        ReaderMonitor().deleteObserver(self.readers)
+
+    def send(self, event, reader):
+        with self.lock:
+            self.socket.send_multipart([event, str(reader)])
+
+
+class CardEvents(CardObserver):
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    def update(self, observable, actions):
+        added, removed = actions
+        # A card reseated between two polls is a removal, then an insertion
+        for card in removed:
+            self.monitor.send(REMOVED, card.reader)
+        for card in added:
+            self.monitor.send(INSERTED, card.reader)
+
+
+class ReaderEvents(ReaderObserver):
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    def update(self, observable, actions):
+        added, removed = actions
+        for reader in removed:
+            self.monitor.send(DETACHED, reader)
+        for reader in added:
+            self.monitor.send(ATTACHED, reader)
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
-import threading
-import Queue
-import math
+import time
+import binascii
+import argparse
+from collections import OrderedDict
 
 import gobject
 import dbus
@@ -15,22 +16,170 @@ import sys
 import logging
 import os
 from zmq.auth.thread import ThreadAuthenticator
-from smartcard.util import toHexString
+
+from rsap import HexDump, MessageDump, messageName, messageID, RSAPFramer, RSAPMessageProtocol
+from apducache import FileCache, RecordReadAhead, MF, INS_SELECT, INS_READ_RECORD, \
+    USIM_RID, warmupMF, warmupADF, applicationID
+import transport
+import tracing
+import metrics
+import readiness
+
+SERVER_ADDRESS = 'tcp://192.168.0.10:9000'
+
+# How often the connection to the server is looked after, in milliseconds
+TICK_INTERVAL = 100
+# Seconds to wait before making a new connection after the last one
+# failed, doubled after each failure up to MAX_BACKOFF
+MIN_BACKOFF = 0.1
+MAX_BACKOFF = 10.0
+# With several servers to choose from, each is pinged every PROBE_INTERVAL
+# seconds and counts as healthy while it answered in the last PROBE_TIMEOUT
+PROBE_INTERVAL = 2.0
+PROBE_TIMEOUT = 3 * PROBE_INTERVAL
+# Weight of a new round trip time in the running average
+RTT_WEIGHT = 0.3
+# An idle relay moves to a server that takes at most this share of the
+# current one's round trip time
+SWITCH_RATIO = 0.5
+
+MESSAGES = metrics.counter('rsap_relay_messages_total',
+                           "RSAP messages received from the modem, by type", ('type',))
+ROUND_TRIP = metrics.histogram('rsap_relay_round_trip_seconds',
+                               "Time from sending a request to the server to its reply")
+LATENCY = metrics.histogram('rsap_relay_reply_seconds',
+                            "Time from a fragment arriving from the modem to its answer")
+IN_FLIGHT = metrics.gauge('rsap_relay_requests_in_flight',
+                          "Requests sent to the server and not answered yet")
+HELD = metrics.gauge('rsap_relay_messages_held',
+                     "Messages from the modem held back during the cache warm-up")
+RECONNECTS = metrics.counter('rsap_relay_reconnects_total',
+                             "New connections made to the server after it stopped answering")
 
 class DemoException(dbus.DBusException):
     _dbus_error_name = 'org.smart_e.DemoException'
 
+class Reply:
+    ''' Answer to one processAPDU call: the responses to every message its
+    fragment completed, in order, whether they come from the cache or from
+    the server '''
+    def __init__(self, count, replyHandler, trace=None, session=None):
+        self.trace = trace
+        self.session = session
+        self.start = time.time()
+        self.parts = [None] * count
+        self.missing = count
+        self.replyHandler = replyHandler
+
+    def part(self, index):
+        return lambda response: self.fill(index, response)
+
+    def fill(self, index, response):
+        self.parts[index] = bytes(response)
+        self.missing -= 1
+        if self.missing == 0:
+            reply = ''.join(self.parts)
+            logging.debug("OUTGOING > %s", HexDump(reply))
+            if self.trace is not None:
+                self.trace.record(tracing.OUT, reply, self.session)
+            LATENCY.labels().observe(time.time() - self.start)
+            self.replyHandler(dbus.ByteArray(reply))
+
+
+class ServerEndpoint:
+    ''' One of the SIM servers the relay can use. When there are several,
+    each is pinged on a socket of its own, to measure its round trip time
+    and learn which cards it serves. '''
+    def __init__(self, address):
+        self.address = address
+        self.rtt = None
+        self.cards = []
+        self.lastAnswer = None
+        self.lastProbe = 0
+        self.probe = None
+        # Time each ping in flight was sent, by sequence number
+        self.sent = {}
+
+    def answered(self, rtt, cards, now):
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += RTT_WEIGHT * (rtt - self.rtt)
+        self.cards = cards
+        self.lastAnswer = now
+
+    def healthy(self, now):
+        return self.lastAnswer is not None and now - self.lastAnswer < PROBE_TIMEOUT
+
+    def serves(self, iccid):
+        return iccid is None or iccid in self.cards
+
+
 class Server(dbus.service.Object):
-    def __init__(self):
-        bus_name = dbus.service.BusName("org.smart_e.RSAP", bus=dbus.SystemBus())
-        dbus.service.Object.__init__(self, bus_name, '/RSAPServer')
-        self.buffer = []
-        self.state = "CONNECT_REQ"
-        self.reqQueue = Queue.Queue()
-        self.respQueue = Queue.Queue()
+    def __init__(self, binary=True, iccid=None, identity=None,
+                 cache=True, cacheSize=512, cacheTTL=3600, warmup=True, batch=0,
+                 deadline=10.0, heartbeat=5.0,
+                 address=SERVER_ADDRESS, base_dir=None, export=True, trace=None):
+        if export:
+            bus_name = dbus.service.BusName("org.smart_e.RSAP", bus=dbus.SystemBus())
+            dbus.service.Object.__init__(self, bus_name, '/RSAPServer')
+        else:
+            # Not on the bus, processAPDU is only called directly
+            dbus.service.Object.__init__(self)
+        # Requests sent to the server and not answered yet, keyed by the
+        # sequence number that the server echoes back in its reply header.
+        # Values are (handler, time sent, messages), the handler being
+        # called with the reply (a list of replies for a batch), or None if
+        # it is not needed. JSON replies carry no sequence number, so in
+        # JSON mode only one request is in flight at a time: the server
+        # answers cache hits ahead of commands waiting for the card.
+        self.pending = OrderedDict()
+        # The server is expected to answer every request within deadline
+        # seconds, and is sent a heartbeat after heartbeat seconds without
+        # traffic. If it does not answer, the socket is replaced by a new
+        # one, and the CONNECT_REQ and TRANSFER_ATR_REQ that the modem last
+        # sent are replayed on it, so the server's session is back in the
+        # state the modem thinks it is in.
+        self.deadline = deadline
+        self.heartbeat = heartbeat
+        self.handshake = []
+        self.lastActivity = time.time()
+        self.backoff = MIN_BACKOFF
+        self.nextAttempt = 0
+        self.serverEpoch = None
+        # Messages are reassembled here rather than on the server, so reads
+        # can be answered from the cache
+        self.framer = RSAPFramer()
+        self.rsap = RSAPMessageProtocol()
+        self.cache = FileCache(cacheSize, cacheTTL) if cache else None
+        self.warmup = warmup and cache
+        # While the modem has the SIM powered off, APDUs go to the server,
+        # which refuses them, rather than being answered from the cache
+        self.powered = True
+        # Warm-up reads not answered yet, None when not warming up. The
+        # modem's messages are held back meanwhile, as the warm-up moves
+        # the card's selection around.
+        self.warming = None
+        self.held = []
+        # With batching, messages for the server are queued up in the
+        # outbox and sent by flush(), up to batchSize in one request, once
+        # the current main loop callback is done with them. The next
+        # records of a file being read record by record go with them. In
+        # JSON mode the outbox holds the requests waiting for the one in
+        # flight to be answered.
+        self.batchSize = batch if binary else 0
+        self.outbox = []
+        self.readAhead = RecordReadAhead(batch) if self.batchSize > 1 and cache else None
+        self.trace = trace
+        if self.cache is not None:
+            self.cache.exportMetrics('relay')
+        IN_FLIGHT.labels().setFunction(lambda: len(self.pending))
+        HELD.labels().setFunction(lambda: len(self.held))
+        self.roundTrip = ROUND_TRIP.labels()
 
         # These direcotries are generated by the generate_certificates script
-        base_dir = os.path.dirname(__file__)
+        if base_dir is None:
+            base_dir = os.path.dirname(__file__)
         keys_dir = os.path.join(base_dir, 'certificates')
         public_keys_dir = os.path.join(base_dir, 'public_keys')
         secret_keys_dir = os.path.join(base_dir, 'private_keys')
@@ -39,32 +188,72 @@ class Server(dbus.service.Object):
             logging.critical("Certificates are missing - run generate_certificates.py script first")
             sys.exit(1)
 
-        ctx = zmq.Context().instance()
+        self.ctx = zmq.Context().instance()
 
         # Start an authenticator for this context.
-        auth = ThreadAuthenticator(ctx)
+        auth = ThreadAuthenticator(self.ctx)
         auth.start()
         # auth.allow('127.0.0.1')
         # Tell authenticator to use the certificate in a directory
         auth.configure_curve(domain='*', location=public_keys_dir)
 
-        client = ctx.socket(zmq.REQ)
-
         # We need two certificates, one for the client and one for
         # the server. The client must know the server's public key
         # to make a CURVE connection.
         client_secret_file = os.path.join(secret_keys_dir, "client.key_secret")
-        client_public, client_secret = zmq.auth.load_certificate(client_secret_file)
-        client.curve_secretkey = client_secret
-        client.curve_publickey = client_public
-
+        self.clientKeys = zmq.auth.load_certificate(client_secret_file)
         server_public_file = os.path.join(public_keys_dir, "server.key")
-        server_public, _ = zmq.auth.load_certificate(server_public_file)
+        self.serverKey, _ = zmq.auth.load_certificate(server_public_file)
+
+        # address may be a list of servers holding the same SIM profiles.
+        # The relay uses the one with the lowest round trip time of those
+        # that answer and serve its card, and moves to another when it
+        # stops answering.
+        addresses = [address] if isinstance(address, basestring) else list(address)
+        self.endpoints = [ServerEndpoint(a) for a in addresses]
+        self.endpoint = self.endpoints[0]
+        # A stable identity keeps this relay on the same card of a SIM
+        # farm, and on the same session, across reconnects
+        self.identity = identity or binascii.hexlify(os.urandom(8))
+        self.binary = binary
+        self.iccid = iccid
+        # ICCID of the card serving the modem, once known
+        self.profile = iccid
+        self.seq = 0
+        self.probeSeq = 0
+        self.connect()
+        if len(self.endpoints) > 1:
+            for endpoint in self.endpoints:
+                self.openProbe(endpoint)
+        gobject.timeout_add(TICK_INTERVAL, self.onTick)
+
+    def newSocket(self, address, identity=None):
+        # DEALER rather than REQ, so several requests can be in flight at
+        # once, and so a lost reply never wedges the socket. Each one is
+        # sent with an empty delimiter frame, the envelope the server's
+        # ROUTER socket expects in front of a request.
+        client = self.ctx.socket(zmq.DEALER)
+        client.linger = 0
+        client.curve_publickey, client.curve_secretkey = self.clientKeys
         # The client must know the server's public key to make a CURVE connection.
-        client.curve_serverkey = server_public
-        client.connect('tcp://192.168.0.10:9000')
+        client.curve_serverkey = self.serverKey
+        # Only applies to connections made after it is set
+        if identity is not None:
+            client.identity = identity
+        client.connect(address)
+        return client
+
+    def connect(self):
+        self.client = self.newSocket(self.endpoint.address, self.identity)
+        self.watch = gobject.io_add_watch(self.client.getsockopt(zmq.FD), gobject.IO_IN,
+                                          self.onServerReadable)
 
-        self.client = client
+    def openProbe(self, endpoint):
+        endpoint.probe = self.newSocket(endpoint.address)
+        # Pings to a server that is away are not worth queueing up
+        endpoint.probe.sndhwm = 1
+        gobject.io_add_watch(endpoint.probe.getsockopt(zmq.FD), gobject.IO_IN,
+                             lambda *args: self.onProbeReadable(endpoint))
 
     @dbus.service.method("org.smart_e.RSAPServer",
                           in_signature='', out_signature='')
@@ -72,49 +261,420 @@ class Server(dbus.service.Object):
         return
 
     @dbus.service.method("org.smart_e.RSAPServer",
-                         in_signature='ay', out_signature='ay')
-    def processAPDU(self, inCommand):
-        print 'INCOMING > ', toHexString(list(bytearray(inCommand)))
-        relay = []
-        for i in inCommand:
-            num = i & 0xFF
-            relay.append(num)
-        self.reqQueue.put(relay)
-        # FIXME: the logic is broken - either there is no concurrency, 
-        # or no direct matching between FIFO request and response queues
-        resp = self.respQueue.get()
-        return resp
-
-    def apduProcessor(self):
-        while True:
+                         in_signature='ay', out_signature='ay',
+                         byte_arrays=True,
+                         async_callbacks=('replyHandler', 'errorHandler'))
+    def processAPDU(self, inCommand, replyHandler, errorHandler):
+        logging.debug("INCOMING > %s", HexDump(inCommand))
+        if self.trace is not None:
+            self.trace.record(tracing.IN, inCommand, self.identity)
+        messages = self.framer.feed(inCommand)
+        if not messages:
+            # The rest of the message comes with the next call
+            replyHandler(dbus.ByteArray(''))
+            return
+        # Reply to D-Bus later, once every part of the answer is there, so
+        # the main loop never waits for the network round trip
+        reply = Reply(len(messages), replyHandler, self.trace, self.identity)
+        for index, message in enumerate(messages):
+            self.handleMessage(message, reply.part(index))
+        self.flush()
+        # The ZMQ fd is edge triggered and sending can consume its edge
+        self.onServerReadable()
+
+    @dbus.service.signal("org.smart_e.RSAPServer", signature='ay')
+    def Indication(self, message):
+        ''' A message from the server that ofono did not ask for: STATUS_IND
+        or DISCONNECT_IND '''
+        logging.info("Indication from the server: %s", HexDump(message))
+
+    def onPush(self, message):
+        message = bytearray(message)
+        logging.debug("PUSHED > %s", MessageDump(message))
+        if self.trace is not None:
+            self.trace.record(tracing.OUT, message, self.identity)
+        if self.cache is not None and len(message) and \
+                message[0] in (messageName['STATUS_IND'], messageName['DISCONNECT_IND']):
+            # The card was removed, reset or replaced: nothing cached holds
+            self.cache.reset()
+            if self.readAhead is not None:
+                self.readAhead.reset()
+        self.Indication(dbus.ByteArray(bytes(message)))
+
+    def handleMessage(self, message, deliver):
+        if self.warming is not None:
+            self.held.append((message, deliver))
+            return
+        mID = message[0]
+        MESSAGES.labels(messageID.get(mID, '0x%02X' % mID)).inc()
+        if mID == messageName['CONNECT_REQ']:
+            self.handshake = [message]
+        elif mID == messageName['TRANSFER_ATR_REQ']:
+            self.handshake = self.handshake[:1] + [message]
+        if mID == messageName['POWER_SIM_OFF_REQ']:
+            self.powered = False
+        elif mID in (messageName['CONNECT_REQ'], messageName['POWER_SIM_ON_REQ']):
+            self.powered = True
+        if self.cache is None or not self.powered:
+            self.send(message, deliver)
+            return
+        if mID == messageName['TRANSFER_APDU_REQ']:
             try:
-                inCommand = self.reqQueue.get()
-            except Queue.Empty:
-                pass
+                apdu = self.rsap.extractAPDU_REQ(message)
+            except ValueError:
+                # Not for the cache, the server answers it
+                self.send(message, deliver)
+                return
+            self.transferAPDU(apdu, message, deliver)
+            return
+        if mID == messageName['CONNECT_REQ']:
+            # Could be a different card from now on
+            if not self.cacheValid():
+                self.cache.reset()
+            self.cache.resetSelection()
+        elif mID == messageName['TRANSFER_ATR_REQ']:
+            # The card has just been reset, which selects the MF
+            self.cache.resetSelection((MF,))
+        elif mID in (messageName['RESET_SIM_REQ'], messageName['POWER_SIM_OFF_REQ'],
+                     messageName['POWER_SIM_ON_REQ']):
+            self.cache.resetSelection()
+        self.send(message, deliver)
+        if mID == messageName['TRANSFER_ATR_REQ'] and self.warmup:
+            if self.cacheValid():
+                # Warmed up for this card already, e.g. before the modem
+                # connected again
+                self.selectMF()
+            else:
+                self.startWarmup()
+
+    def cacheValid(self):
+        ''' Whether the cache holds the files of the card the server serves,
+        as far as the relay knows it: the cached ICCID has not expired, and
+        is the one the server last reported for the relay, if it did '''
+        iccid = self.cache.iccid()
+        return iccid is not None and self.profile in (None, iccid)
+
+    def transferAPDU(self, apdu, message, deliver):
+        readAhead = self.readAhead
+        if readAhead is not None:
+            readAhead.observe(apdu)
+        response, token = self.cache.lookup(apdu)
+        if response is None and token is None and readAhead is not None:
+            response = readAhead.lookup(apdu)
+        if response is not None:
+            deliver(self.rsap.generateTRANSFER_APDU_RESP(response))
+            return
+        for select in self.cache.takePendingSelects():
+            self.send(self.rsap.generateTRANSFER_APDU_REQ(select), None)
+
+        def onResponse(reply):
+            apduResponse = self.apduResponse(reply)
+            if apduResponse is not None:
+                self.cache.update(token, apduResponse)
+                if readAhead is not None and bytearray(apdu[1:2]) == bytearray([INS_SELECT]):
+                    readAhead.selected(apduResponse)
+            deliver(reply)
+        self.send(message, onResponse)
+        if readAhead is not None and token is None:
+            generation = readAhead.generation
+            for read in readAhead.following(apdu):
+                self.send(self.rsap.generateTRANSFER_APDU_REQ(read),
+                          lambda reply, read=read: self.onReadAhead(generation, read, reply))
+
+    def apduResponse(self, reply):
+        ''' The ResponseAPDU in a reply from the server, or None '''
+        if len(reply) and bytearray(reply[:1])[0] == messageName['TRANSFER_APDU_RESP']:
+            return self.rsap.extractAPDU_RESP(bytearray(reply))
+        return None
+
+    def onReadAhead(self, generation, apdu, reply):
+        response = self.apduResponse(reply)
+        if response is not None:
+            self.readAhead.store(generation, apdu, response)
+
+    def send(self, message, handler):
+        if self.batchSize > 1 or (not self.binary and (self.pending or self.outbox)):
+            self.outbox.append((message, handler))
+            return
+        self.sendRequest(message, handler)
+
+    def sendRequest(self, message, handler):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        self.lastActivity = time.time()
+        self.pending[self.seq] = (handler, self.lastActivity, [message])
+        frames = transport.encode(message, self.seq, self.binary, iccid=self.iccid)
+        self.client.send_multipart([b''] + frames)
+
+    def flush(self):
+        ''' Send the messages queued up in the outbox, batchSize at most in
+        one request, or the next one in JSON mode once nothing is in
+        flight '''
+        if not self.binary:
+            if self.outbox and not self.pending:
+                message, handler = self.outbox.pop(0)
+                self.sendRequest(message, handler)
+            return
+        while self.outbox:
+            batch = self.outbox[:self.batchSize]
+            del self.outbox[:self.batchSize]
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            if len(batch) == 1:
+                message, handler = batch[0]
+                frames = transport.encode(message, self.seq, iccid=self.iccid)
+            else:
+                messages, handlers = zip(*batch)
+                handler = lambda replies, handlers=handlers: self.onBatchReply(handlers, replies)
+                frames = transport.encodeBatch(messages, self.seq, iccid=self.iccid)
+            self.lastActivity = time.time()
+            self.pending[self.seq] = (handler, self.lastActivity, [message for message, _ in batch])
+            self.client.send_multipart([b''] + frames)
+
+    def onBatchReply(self, handlers, replies):
+        if len(replies) != len(handlers):
+            logging.warning("Batch of %d answered with %d replies", len(handlers), len(replies))
+        for handler, reply in zip(handlers, replies):
+            if handler is not None:
+                handler(reply)
+
+    def startWarmup(self):
+        ''' Read the files the modem is about to read, while it is still
+        busy with the ATR, so the reads it makes next hit the cache '''
+        self.warming = 0
+        self.adfWarmup = False
+        self.warmUp(warmupMF())
+
+    def warmUp(self, apdus):
+        # Counted up front, as cached ones are answered straight away
+        self.warming += len(apdus)
+        for apdu in apdus:
+            message = self.rsap.generateTRANSFER_APDU_REQ(apdu)
+            self.transferAPDU(apdu, message,
+                              lambda reply, apdu=apdu: self.onWarmupReply(apdu, reply))
+
+    def onWarmupReply(self, apdu, reply):
+        self.warming -= 1
+        if apdu[1] == INS_READ_RECORD and not self.adfWarmup:
+            # EF_DIR, the only record based file read under the MF, lists
+            # the applications on the card
+            response = self.rsap.extractAPDU_RESP(bytearray(reply))
+            aid = applicationID(response[:-2]) if response is not None else None
+            if aid is not None and list(bytearray(aid[:len(USIM_RID)])) == USIM_RID:
+                self.adfWarmup = True
+                self.warmUp(warmupADF(aid))
+        if self.warming == 0:
+            self.finishWarmup()
+
+    def selectMF(self):
+        ''' Leave the MF selected, as the modem expects after the ATR '''
+        self.cache.takePendingSelects()
+        self.cache.resetSelection((MF,))
+        selectMF = [0x00, INS_SELECT, 0x00, 0x0C, 0x02, MF >> 8, MF & 0xFF]
+        self.send(self.rsap.generateTRANSFER_APDU_REQ(selectMF), None)
+
+    def finishWarmup(self):
+        self.selectMF()
+        self.warming = None
+        held, self.held = self.held, []
+        for message, deliver in held:
+            self.handleMessage(message, deliver)
+
+    def onServerReadable(self, *args):
+        while self.client.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            frames = self.client.recv_multipart(zmq.NOBLOCK)[1:]
+            if transport.isPush(frames):
+                self.lastActivity = time.time()
+                self.onPush(transport.decode(frames)[0])
+                continue
+            if transport.isBatch(frames):
+                reply, seq = transport.decodeBatch(frames)
             else:
-                resp = self.process(inCommand)
-                self.respQueue.put(resp)
+                reply, seq, _ = transport.decode(frames)
+            if seq is None:
+                # JSON replies carry no sequence number, it answers the
+                # only request in flight
+                seq = next(iter(self.pending), None)
+            if seq not in self.pending:
+                logging.warning("Dropping reply to unknown request %s", seq)
+                continue
+            handler, sent, _ = self.pending.pop(seq)
+            self.lastActivity = time.time()
+            self.roundTrip.observe(self.lastActivity - sent)
+            self.backoff = MIN_BACKOFF
+            if handler is not None:
+                handler(reply)
+        # Handlers may have queued up more, e.g. the rest of the warm-up
+        self.flush()
+        return True
+
+    def onTick(self):
+        now = time.time()
+        if len(self.endpoints) > 1:
+            self.probe(now)
+            if not self.pending and self.warming is None:
+                best = self.bestEndpoint(now)
+                current = self.endpoint
+                if best is not None and best is not current and \
+                        (not current.healthy(now) or best.rtt < current.rtt * SWITCH_RATIO):
+                    self.moveTo(best)
+                    self.resynchronise()
+        if self.pending:
+            _, sent, _ = next(self.pending.itervalues())
+            if now - sent > self.deadline and now >= self.nextAttempt:
+                self.reconnect(now)
+        elif now - self.lastActivity >= self.heartbeat:
+            self.ping()
+        return True
+
+    def ping(self):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        self.lastActivity = time.time()
+        self.pending[self.seq] = (self.onPong, self.lastActivity, [])
+        if self.binary:
+            frames = transport.encodePing(self.seq)
+        else:
+            frames = transport.encode(b'', binary=False)
+        self.client.send_multipart([b''] + frames)
+
+    def onPong(self, payload):
+        epoch, card, cards = transport.decodePong(payload)
+        if self.serverEpoch is not None and epoch != self.serverEpoch:
+            logging.warning("The server was restarted, connecting again")
+            self.resynchronise()
+        self.serverEpoch = epoch
+        if card:
+            self.profile = card
+
+    def probe(self, now):
+        for endpoint in self.endpoints:
+            if now - endpoint.lastProbe < PROBE_INTERVAL:
+                continue
+            endpoint.lastProbe = now
+            for seq, sent in endpoint.sent.items():
+                if now - sent > PROBE_TIMEOUT:
+                    del endpoint.sent[seq]
+            self.probeSeq = (self.probeSeq + 1) & 0xFFFFFFFF
+            try:
+                endpoint.probe.send_multipart([b''] + transport.encodePing(self.probeSeq),
+                                              zmq.NOBLOCK)
+            except zmq.Again:
+                continue
+            endpoint.sent[self.probeSeq] = now
+
+    def onProbeReadable(self, endpoint):
+        while endpoint.probe.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            frames = endpoint.probe.recv_multipart(zmq.NOBLOCK)[1:]
+            payload, seq, _ = transport.decode(frames)
+            sent = endpoint.sent.pop(seq, None)
+            if sent is not None:
+                now = time.time()
+                _, _, cards = transport.decodePong(payload)
+                endpoint.answered(now - sent, cards, now)
+        return True
+
+    def bestEndpoint(self, now, exclude=None):
+        ''' The healthy server with the lowest round trip time that serves
+        the modem's card, or None '''
+        candidates = [endpoint for endpoint in self.endpoints
+                      if endpoint is not exclude and endpoint.healthy(now)
+                      and endpoint.serves(self.profile)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda endpoint: endpoint.rtt)
 
-    def process(self, inCommand):
-        # print "<", toHexString(inCommand)
-        self.client.send_json(inCommand)
-        apduResponse = self.client.recv_json()
-        bArrResp = list(bytearray(apduResponse))
-        print "OUTGOING > ", toHexString(bArrResp)
-        return apduResponse
+    def moveTo(self, endpoint):
+        ''' Replace the connection by a new one to endpoint '''
+        if endpoint is not self.endpoint:
+            logging.warning("Moving to the server at %s", endpoint.address)
+            self.serverEpoch = None
+        gobject.source_remove(self.watch)
+        self.client.close()
+        self.endpoint = endpoint
+        # Wherever the relay ends up, it asks for the same card
+        if self.iccid is None:
+            self.iccid = self.profile
+        self.connect()
 
+    def reconnect(self, now):
+        logging.warning("No answer from the server in %.1f s, reconnecting", self.deadline)
+        RECONNECTS.labels().inc()
+        # Not healthy again until it answers a probe
+        self.endpoint.lastAnswer = None
+        self.moveTo(self.bestEndpoint(now, exclude=self.endpoint) or self.endpoint)
+        self.nextAttempt = now + self.backoff
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        failed, self.pending = self.pending, OrderedDict()
+        self.resynchronise()
+        # Fail what was lost rather than leave the modem waiting for it. If
+        # the cache was warming up, that finishes it.
+        for handler, _, messages in failed.values():
+            if handler is None or not messages:
+                continue
+            replies = [self.rsap.generateFailure(message) for message in messages]
+            handler(replies if len(messages) > 1 else replies[0])
+        self.flush()
+
+    def resynchronise(self):
+        ''' Take the server's session through the modem's handshake again,
+        and forget which file is selected on its card '''
+        if self.cache is not None:
+            self.cache.resetSelection()
+        if self.readAhead is not None:
+            self.readAhead.reset()
+        # Ahead of anything still waiting to be sent
+        queued, self.outbox = self.outbox, []
+        for message in self.handshake:
+            self.send(message, None)
+        self.outbox.extend(queued)
+        self.flush()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Relay RSAP messages from ofono to a SIM server")
+    parser.add_argument('--json', action='store_true',
+                        help="use the JSON encoding understood by older servers")
+    parser.add_argument('--server', metavar='ADDRESS', action='append',
+                        help="SIM server, e.g. tcp://192.168.0.10:9000 (the default). Given "
+                        "several times, the relay uses the fastest one serving its card and "
+                        "fails over to the others")
+    parser.add_argument('--sim', metavar='ICCID',
+                        help="ask a SIM farm for this card")
+    parser.add_argument('--identity',
+                        help="ZMQ identity, keeps the relay on the same farm card")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="send every APDU to the server")
+    parser.add_argument('--no-warmup', action='store_true',
+                        help="do not read ahead the SIM files after the ATR")
+    parser.add_argument('--cache-size', type=int, default=512,
+                        help="most responses kept in the cache")
+    parser.add_argument('--cache-ttl', type=float, default=3600,
+                        help="seconds a cached response is used for")
+    parser.add_argument('--deadline', type=float, default=10.0,
+                        help="seconds the server has to answer before the connection is made again")
+    parser.add_argument('--heartbeat', type=float, default=5.0,
+                        help="seconds without traffic after which the server is pinged")
+    parser.add_argument('--batch', type=int, default=0, metavar='N',
+                        help="send up to N messages to the server in one request, and read "
+                        "ahead N records of files read record by record (needs a server "
+                        "that understands batches)")
+    tracing.addArguments(parser)
+    metrics.addArguments(parser)
+    args = parser.parse_args()
+    trace = tracing.configure(args)
+    endpoint = metrics.configure(args)
+
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-    dbus.mainloop.glib.threads_init()
-    RSAPServer = Server()
-    gobject.threads_init()
+    RSAPServer = Server(binary=not args.json, iccid=args.sim, identity=args.identity,
+                        address=args.server or SERVER_ADDRESS,
+                        cache=not args.no_cache, cacheSize=args.cache_size,
+                        cacheTTL=args.cache_ttl, warmup=not args.no_warmup,
+                        batch=args.batch, deadline=args.deadline, heartbeat=args.heartbeat,
+                        trace=trace)
+    if endpoint is not None:
+        # Scrapes are answered from the main loop, no thread needed
+        gobject.io_add_watch(endpoint.fileno(), gobject.IO_IN, endpoint.onReadable)
     mainloop = gobject.MainLoop()
 
-    apduProcessor = threading.Thread(target=RSAPServer.apduProcessor)
-    apduProcessor.setDaemon(True)
-    apduProcessor.start()
-
-    print "Running RSAP service."
+    logging.info("Running RSAP service.")
+    # The D-Bus name is taken, ZMQ connects to the server in the background
+    readiness.ready()
     mainloop.run()
@@ -12,8 +12,11 @@ Author: Chris Laws
 
 import os
 import shutil
+import argparse
 import zmq.auth
 
+from keystore import writeCertificate
+
 def generate_certificates(base_dir):
     ''' Generate client and server CURVE certificate files'''
     keys_dir = os.path.join(base_dir, 'certificates')
@@ -42,8 +45,78 @@ def generate_certificates(base_dir):
             shutil.move(os.path.join(keys_dir, key_file),
                         os.path.join(secret_keys_dir, '.'))
 
+def issue_clients(base_dir, names, sims=()):
+    ''' Generate a certificate for each of the clients in names, allowed
+    to use the SIMs in sims (any if empty). The public one goes to
+    public_keys, where a running server accepts it within a second, and the
+    secret one to certificates, to be installed on the relay as
+    private_keys/client.key_secret. '''
+    keys_dir = os.path.join(base_dir, 'certificates')
+    public_keys_dir = os.path.join(base_dir, 'public_keys')
+    for d in [keys_dir, public_keys_dir]:
+        if not os.path.exists(d):
+            os.mkdir(d)
+
+    metadata = {'sims': ','.join(sims)} if sims else {}
+    for name in names:
+        public, secret = zmq.curve_keypair()
+        metadata['identity'] = name
+        writeCertificate(os.path.join(keys_dir, name + '.key_secret'), public, secret, metadata)
+        writeCertificate(os.path.join(public_keys_dir, name + '.key'), public, None, metadata)
+
+def existing_certificates(base_dir):
+    ''' Names of the public certificates in public_keys, those of the
+    clients issued with --issue included '''
+    public_keys_dir = os.path.join(base_dir, 'public_keys')
+    if not os.path.exists(public_keys_dir):
+        return []
+    return sorted(key_file[:-len('.key')] for key_file in os.listdir(public_keys_dir)
+                  if key_file.endswith('.key'))
+
+def revoke_clients(base_dir, names):
+    ''' Remove the public certificates of the clients in names, which a
+    running server then refuses '''
+    public_keys_dir = os.path.join(base_dir, 'public_keys')
+    for name in names:
+        path = os.path.join(public_keys_dir, name + '.key')
+        if os.path.exists(path):
+            os.remove(path)
+        else:
+            print "No certificate for", name
+
 if __name__ == '__main__':
     if zmq.zmq_version_info() < (4,0):
         raise RuntimeError("Security is not supported in libzmq version < 4.0. libzmq version {0}".format(zmq.zmq_version()))
 
-    generate_certificates(os.path.dirname(__file__))
+    parser = argparse.ArgumentParser(description="Generate the server and client certificates, "
+                                     "or with --issue and --revoke manage those of many relays")
+    parser.add_argument('--issue', nargs='+', metavar='NAME', default=[],
+                        help="add a client certificate for each NAME, keeping the others; with "
+                        "--count, NAME is a pattern such as relay-%%03d")
+    parser.add_argument('--count', type=int,
+                        help="issue this many certificates, numbered from 1")
+    parser.add_argument('--sim', action='append', metavar='ICCID', default=[],
+                        help="only allow the issued clients this SIM, can be given several times")
+    parser.add_argument('--revoke', nargs='+', metavar='NAME', default=[],
+                        help="remove the certificates of these clients")
+    parser.add_argument('--regenerate', action='store_true',
+                        help="replace existing certificates with new server and client ones, "
+                        "revoking every issued client")
+    args = parser.parse_args()
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    names = args.issue
+    if args.count:
+        names = [pattern % number for pattern in names for number in xrange(1, args.count + 1)]
+    if names:
+        issue_clients(base_dir, names, args.sim)
+    if args.revoke:
+        revoke_clients(base_dir, args.revoke)
+    if not names and not args.revoke:
+        existing = existing_certificates(base_dir)
+        if existing and not args.regenerate:
+            issued = [name for name in existing if name not in ('server', 'client')]
+            parser.error("public_keys already holds certificates (%d issued with --issue), "
+                         "regenerating them would revoke every relay: give --regenerate to "
+                         "do it anyway" % len(issued))
+        generate_certificates(base_dir)
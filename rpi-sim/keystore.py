@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+CURVE client keys of the relays allowed to use the SIM server.
+
+Every client has a certificate in public_keys/, in the ZMQ certificate format,
+whose metadata may name the client and the SIMs it may use:
+
+    metadata
+        identity = "relay-042"
+        sims = "8944000000000000001,8944000000000000002"
+    curve
+        public-key = "..."
+
+Without an identity the client is named after its file, and without sims it
+may use any card. KeyStore indexes the certificates by public key, so a
+handshake costs one dictionary lookup however many relays there are, and
+follows the directory while the server runs: a certificate put in it is
+accepted within RELOAD_INTERVAL seconds, one deleted from it is refused.
+Only new, changed or deleted files are read again. Certificates are replaced
+(written elsewhere and renamed in, as generate_certificates.py does) rather
+than edited in place, which the directory would not show.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import namedtuple
+
+# Seconds between looks at the directory, at most
+RELOAD_INTERVAL = 1.0
+
+CERTIFICATE = u'''#   ****  Generated on {0} by generate_certificates.py  ****
+#   ZeroMQ CURVE {1} Certificate
+#   Exchange securely, or use a secure mechanism to verify the contents
+#   of this file after exchange. Store public certificates in your home
+#   directory, in the .curve subdirectory.
+
+'''
+
+
+class Client(namedtuple('Client', 'key name sims')):
+    ''' A client's public key (Z85), name, and the ICCIDs it may use, all of
+    them if empty '''
+    __slots__ = ()
+
+    def allows(self, iccid):
+        return not self.sims or iccid in self.sims
+
+
+def readCertificate(path):
+    ''' Returns (public key, metadata) from a certificate file '''
+    section = None
+    key = None
+    metadata = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            if not line[0].isspace():
+                section = line.strip()
+                continue
+            name, _, value = line.partition('=')
+            name, value = name.strip(), value.strip().strip('"')
+            if section == 'metadata':
+                metadata[name] = value
+            elif section == 'curve' and name == 'public-key':
+                key = value
+    if key is None:
+        raise ValueError('No public key in %s' % path)
+    return key, metadata
+
+
+def writeCertificate(path, public, secret=None, metadata=None):
+    ''' Write a certificate file, in place of any there was at once '''
+    lines = [CERTIFICATE.format(time.strftime('%Y-%m-%d %H:%M:%S'),
+                                'Secret' if secret else 'Public'), 'metadata\n']
+    for name, value in sorted((metadata or {}).items()):
+        lines.append('    %s = "%s"\n' % (name, value))
+    lines.append('curve\n')
+    lines.append('    public-key = "%s"\n' % public)
+    if secret:
+        lines.append('    secret-key = "%s"\n' % secret)
+    temporary = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    with open(temporary, 'w') as f:
+        f.write(''.join(lines))
+    if secret:
+        os.chmod(temporary, 0600)
+    os.rename(temporary, path)
+
+
+def clientFromCertificate(path):
+    key, metadata = readCertificate(path)
+    name = metadata.get('identity') or os.path.splitext(os.path.basename(path))[0]
+    sims = frozenset(sim.strip() for sim in metadata.get('sims', '').split(',') if sim.strip())
+    return Client(key, name, sims)
+
+
+class KeyStore:
+    ''' The clients whose certificates are in location, by public key.
+    Passed to the authenticator with configure_curve_callback(), and looked
+    up by the server with the User-Id the authenticator gives each
+    connection, which is the client's public key. '''
+    def __init__(self, location, interval=RELOAD_INTERVAL):
+        self.location = location
+        self.interval = interval
+        # Used from the authenticator's thread and the server's
+        self.lock = threading.Lock()
+        self.clients = {}
+        # Key and modification time of each file read, by file name
+        self.files = {}
+        self.checked = 0
+        self.stamp = None
+        self.refresh(force=True)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def refresh(self, force=False):
+        ''' Read the certificates added, changed or deleted since the last
+        look, if the directory changed and it is time to look again '''
+        now = time.time()
+        if not force and now - self.checked < self.interval:
+            return
+        if not self.lock.acquire(False):
+            # Another thread is at it
+            return
+        try:
+            self.checked = now
+            try:
+                stamp = os.stat(self.location).st_mtime
+            except OSError as e:
+                logging.error("Cannot read client keys from %s: %s", self.location, e)
+                return
+            if stamp != self.stamp:
+                self.stamp = stamp
+                self.reload()
+        finally:
+            self.lock.release()
+
+    def reload(self):
+        seen = set()
+        added = removed = 0
+        for filename in os.listdir(self.location):
+            if not filename.endswith('.key'):
+                continue
+            path = os.path.join(self.location, filename)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                # Deleted since the listing
+                continue
+            seen.add(filename)
+            known = self.files.get(filename)
+            if known is not None and known[1] == mtime:
+                continue
+            try:
+                client = clientFromCertificate(path)
+            except (IOError, ValueError) as e:
+                logging.warning("Skipping client key %s: %s", path, e)
+                continue
+            if known is not None:
+                self.clients.pop(known[0], None)
+            self.clients[client.key] = client
+            self.files[filename] = (client.key, mtime)
+            added += 1
+        for filename in set(self.files) - seen:
+            key, _ = self.files.pop(filename)
+            self.clients.pop(key, None)
+            removed += 1
+        if added or removed:
+            logging.info("Client keys: %d read, %d revoked, %d in all", added, removed,
+                         len(self.clients))
+
+    def lookup(self, key):
+        ''' The Client with public key (Z85), None if it is not allowed '''
+        self.refresh()
+        return self.clients.get(key)
+
+    def callback(self, domain, key):
+        ''' ZAP check of a connecting client '''
+        client = self.lookup(key)
+        if client is None:
+            logging.warning("Refusing unknown client key %s", key)
+            return False
+        logging.debug("Client %s connecting", client.name)
+        return True
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""
+Counters, histograms and gauges in the Prometheus text format, served over
+HTTP on /metrics.
+
+Metrics are created (or looked up, if another module already made them) with
+counter(), histogram() and gauge(), normally at module level, and used
+through labels(*values):
+
+    MESSAGES = metrics.counter('rsap_messages_total', "RSAP messages", ('type',))
+    MESSAGES.labels('TRANSFER_APDU_REQ').inc()
+
+A labelled child can also be given a function, called whenever the metrics
+are scraped, for values that are already kept elsewhere (sessions in a
+SessionTable, hits counted by a cache, ...):
+
+    SESSIONS.labels(reader).setFunction(lambda: len(self.sessions))
+"""
+
+import time
+import bisect
+import threading
+import BaseHTTPServer
+from collections import OrderedDict
+
+# Seconds, from a cached read on the server up to a slow network round trip
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def formatLabels(names, values, extra=None):
+    pairs = zip(names, values)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                             for name, value in pairs)
+
+
+class Child:
+    def __init__(self, lock):
+        self.lock = lock
+        self.value = 0.0
+        self.function = None
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def setFunction(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class HistogramChild:
+    def __init__(self, lock, buckets):
+        self.lock = lock
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+
+class Timer:
+    ''' with histogram.labels(...).time(): observes the time taken '''
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.child.observe(time.time() - self.start)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.newChild())
+        return child
+
+    def newChild(self):
+        return Child(self.lock)
+
+    def samples(self):
+        ''' Yields (name suffix, label values, extra label, value) '''
+        for values, child in sorted(self.children.items()):
+            yield '', values, None, child.get()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, values, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        formatLabels(self.labelNames, values, extra),
+                                        formatValue(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labelNames)
+        self.buckets = tuple(buckets)
+
+    def newChild(self):
+        return HistogramChild(self.lock, self.buckets)
+
+    def samples(self):
+        for values, child in sorted(self.children.items()):
+            with self.lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', values, ('le', formatValue(bound)), cumulative
+            yield '_sum', values, None, total
+            yield '_count', values, None, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = OrderedDict()
+
+    def get(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('%s is already a %s' % (name, metric.kind))
+            return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelNames=()):
+    return REGISTRY.get(Counter, name, help, labelNames)
+
+
+def gauge(name, help, labelNames=()):
+    return REGISTRY.get(Gauge, name, help, labelNames)
+
+
+def histogram(name, help, labelNames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.get(Histogram, name, help, labelNames, buckets)
+
+
+def ratio(hits, misses):
+    ''' hits / (hits + misses), 0 before anything was looked up '''
+    total = hits + misses
+    return float(hits) / total if total else 0.0
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Endpoint(BaseHTTPServer.HTTPServer):
+    ''' HTTP server for the metrics. Either start() it on its own thread,
+    or call onReadable() whenever its socket is readable from a main loop. '''
+    def __init__(self, port, address='127.0.0.1', registry=REGISTRY):
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port), MetricsHandler)
+        self.registry = registry
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='metrics')
+        thread.setDaemon(True)
+        thread.start()
+
+    def onReadable(self, *args):
+        self.handle_request()
+        return True
+
+
+def addArguments(parser):
+    parser.add_argument('--metrics', type=int, metavar='PORT',
+                        help="serve metrics on http://127.0.0.1:PORT/metrics")
+
+
+def configure(args):
+    ''' Endpoint for the --metrics port from the parsed arguments, not
+    started yet, or None '''
+    if args.metrics is None:
+        return None
+    return Endpoint(args.metrics)
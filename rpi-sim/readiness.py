@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""
+Telling systemd how a daemon is doing, as sd_notify(3) does, without
+depending on libsystemd.
+
+A service started with Type=notify is only considered up once it sends
+READY=1, so units ordered after it (e.g. the relay after the SIM server, on
+a Pi running both) start as soon as the socket is bound rather than after a
+fixed delay. When not started by systemd (NOTIFY_SOCKET unset), nothing is
+sent.
+"""
+
+import os
+import socket
+import logging
+
+
+def notify(state):
+    ''' Send state, e.g. 'READY=1' or 'STATUS=...', newline separated.
+    Returns whether it was sent. '''
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    # Abstract namespace socket
+    if address[0] == '@':
+        address = '\0' + address[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(address)
+        sock.sendall(state)
+        return True
+    except socket.error as e:
+        logging.warning("Could not notify systemd: %s", e)
+        return False
+    finally:
+        sock.close()
+
+
+def ready(status=None):
+    ''' The daemon is ready to serve, with an optional status line '''
+    state = 'READY=1'
+    if status:
+        state += '\nSTATUS=' + status
+    return notify(state)
+
+
+def status(text):
+    return notify('STATUS=' + text)
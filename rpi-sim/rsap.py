@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+
+"""
+Codec for the SIM Access Profile (RSAP) messages exchanged between the
+modem, the command relay and the SIM server.
+
+Messages are kept as bytes/bytearray end to end: headers and parameters are
+read with struct straight out of the receive buffer, parameter values are
+handed out as memoryview slices of it, and responses are packed into a
+single preallocated bytearray. The wire format is unchanged.
+"""
+
+import struct
+
+# Message is of a format:
+# |  1  |  1   |    2   |        varies          |
+#  msgID #param reserved     payload
+#
+# Payload (parameter) looks like
+# |  1  |  1  |    2    |     varies      | 0-3 |
+#  param  rsv. paramLen    parameter value  padding
+#   ID
+# The length of each parameter will be a multiple of 4 bytes - use padding to reach that
+MESSAGE_HEADER = struct.Struct('!BBH')
+PARAMETER_HEADER = struct.Struct('!BxH')
+
+messageID = {
+    0x00: 'CONNECT_REQ',
+    0x01: 'CONNECT_RESP',
+    0x02: 'DISCONNECT_REQ',
+    0x03: 'DISCONNECT_RESP',
+    0x04: 'DISCONNECT_IND',
+    0x05: 'TRANSFER_APDU_REQ',
+    0x06: 'TRANSFER_APDU_RESP',
+    0x07: 'TRANSFER_ATR_REQ',
+    0x08: 'TRANSFER_ATR_RESP',
+    0x09: 'POWER_SIM_OFF_REQ',
+    0x0A: 'POWER_SIM_OFF_RESP',
+    0x0B: 'POWER_SIM_ON_REQ',
+    0x0C: 'POWER_SIM_ON_RESP',
+    0x0D: 'RESET_SIM_REQ',
+    0x0E: 'RESET_SIM_RESP',
+    0x0F: 'TRANSFER_CARD_READER_STATUS_REQ',
+    0x10: 'TRANSFER_CARD_READER_STATUS_RESP',
+    0x11: 'STATUS_IND',
+    0x12: 'ERROR_RESP',
+    0x13: 'SET_TRANSPORT_PROTOCOL_REQ',
+    0x14: 'SET_TRANSPORT_PROTOCOL_RESP'
+}
+messageName = dict((v, k) for k, v in messageID.iteritems())
+
+parameterID = {
+    0x00: 'MaxMsgSize',
+    0x01: 'ConnectionStatus',
+    0x02: 'ResultCode',
+    0x03: 'DisconnectionType',
+    0x04: 'CommandAPDU',
+    0x10: 'CommandAPDU7816',
+    0x05: 'ResponseAPDU',
+    0x06: 'ATR',
+    0x07: 'CardReaderStatus',
+    0x08: 'StatusChange',
+    0x09: 'TransportProtocol'
+}
+parameterName = dict((v, k) for k, v in parameterID.iteritems())
+
+# ResultCode values
+RESULT_OK = 0x00
+RESULT_NO_REASON = 0x01
+RESULT_CARD_NOT_ACCESSIBLE = 0x02
+RESULT_CARD_ALREADY_OFF = 0x03
+RESULT_CARD_REMOVED = 0x04
+RESULT_CARD_ALREADY_ON = 0x05
+RESULT_DATA_NOT_AVAILABLE = 0x06
+RESULT_NOT_SUPPORTED = 0x07
+
+# ConnectionStatus values
+CONNECTION_OK = 0x00
+CONNECTION_FAILED = 0x01
+CONNECTION_MSG_SIZE_UNSUPPORTED = 0x02
+CONNECTION_MSG_SIZE_TOO_SMALL = 0x03
+CONNECTION_OK_ONGOING_CALL = 0x04
+
+# StatusChange values
+STATUS_UNKNOWN_ERROR = 0x00
+STATUS_CARD_RESET = 0x01
+STATUS_CARD_NOT_ACCESSIBLE = 0x02
+STATUS_CARD_REMOVED = 0x03
+STATUS_CARD_INSERTED = 0x04
+STATUS_CARD_RECOVERED = 0x05
+
+# CardReaderStatus bits (GSM 11.14), besides the reader's identity in bits 0-2
+READER_REMOVABLE = 0x08
+READER_PRESENT = 0x10
+READER_ID1_SIZE = 0x20
+READER_CARD_PRESENT = 0x40
+READER_CARD_POWERED = 0x80
+
+# DisconnectionType values
+DISCONNECT_GRACEFUL = 0x00
+DISCONNECT_IMMEDIATE = 0x01
+
+# TransportProtocol values
+PROTOCOL_T0 = 0x00
+PROTOCOL_T1 = 0x01
+
+# Requests answered by a response carrying a ResultCode, the next message ID
+RESULT_REQUESTS = [messageName[name] for name in (
+    'TRANSFER_APDU_REQ', 'TRANSFER_ATR_REQ', 'POWER_SIM_OFF_REQ', 'POWER_SIM_ON_REQ',
+    'RESET_SIM_REQ', 'TRANSFER_CARD_READER_STATUS_REQ', 'SET_TRANSPORT_PROTOCOL_REQ')]
+
+
+def hexString(data):
+    ''' Same format as smartcard.util.toHexString, for any byte sequence '''
+    return ' '.join(['%02X' % b for b in bytearray(data)])
+
+
+class HexDump:
+    ''' Formats as hexString(data), but only once it is actually printed,
+    so it costs nothing as an argument to a disabled log call '''
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return hexString(self.data)
+
+
+def describeMessage(message):
+    ''' Multi-line decoding of a complete message '''
+    mID, params = parseMessage(message)
+    lines = [hexString(message),
+             '%s, %d parameters:' % (messageID.get(mID, '0x%02X' % mID), len(params))]
+    for paramID, value in params:
+        lines.append('%s = %s (length = %d)' % (parameterID.get(paramID, '0x%02X' % paramID),
+                                                hexString(value), len(value)))
+    return '\n'.join(lines)
+
+
+class MessageDump(HexDump):
+    ''' Lazy describeMessage(message) '''
+    __slots__ = ()
+
+    def __str__(self):
+        return describeMessage(self.data)
+
+
+def paddedLength(length):
+    ''' Parameter length rounded up to the next multiple of 4 '''
+    return (length + 3) & ~3
+
+
+def messageLength(data, offset=0):
+    ''' Length of the message starting at offset, or None if it is not
+    complete yet '''
+    available = len(data) - offset
+    if available < MESSAGE_HEADER.size:
+        return None
+    _, parameters, _ = MESSAGE_HEADER.unpack_from(data, offset)
+    length = MESSAGE_HEADER.size
+    for i in xrange(parameters):
+        if available < length + PARAMETER_HEADER.size:
+            return None
+        _, paramLen = PARAMETER_HEADER.unpack_from(data, offset + length)
+        length += PARAMETER_HEADER.size + paddedLength(paramLen)
+        if available < length:
+            return None
+    return length
+
+
+def parseMessage(data):
+    ''' Split a complete message into its ID and a list of
+    (paramID, value) pairs. Values are memoryview slices of data. '''
+    view = memoryview(data)
+    mID, parameters, _ = MESSAGE_HEADER.unpack_from(data, 0)
+    params = []
+    pos = MESSAGE_HEADER.size
+    for i in xrange(parameters):
+        paramID, paramLen = PARAMETER_HEADER.unpack_from(data, pos)
+        start = pos + PARAMETER_HEADER.size
+        params.append((paramID, view[start:start+paramLen]))
+        pos = start + paddedLength(paramLen)
+    return mID, params
+
+
+def getParameter(data, wanted):
+    ''' Value of the first parameter with ID wanted, or None '''
+    for paramID, value in parseMessage(data)[1]:
+        if paramID == wanted:
+            return value
+    return None
+
+
+def buildMessage(mID, params):
+    ''' Pack a message from a list of (paramID, value) pairs, where each
+    value is any byte sequence (bytes, bytearray, memoryview or list of ints).
+    The buffer is allocated once and comes zero-filled, so padding is free. '''
+    length = MESSAGE_HEADER.size
+    for paramID, value in params:
+        length += PARAMETER_HEADER.size + paddedLength(len(value))
+    message = bytearray(length)
+    MESSAGE_HEADER.pack_into(message, 0, mID, len(params), 0)
+    pos = MESSAGE_HEADER.size
+    for paramID, value in params:
+        paramLen = len(value)
+        PARAMETER_HEADER.pack_into(message, pos, paramID, paramLen)
+        start = pos + PARAMETER_HEADER.size
+        message[start:start+paramLen] = value
+        pos = start + paddedLength(paramLen)
+    return message
+
+
+# Largest MaxMsgSize there is, and the one a client that does not give one
+# is assumed to have
+MAX_MSG_SIZE = 0xFFFF
+# TRANSFER_APDU_RESP around a ResponseAPDU, whose length is a 16 bit field
+APDU_RESP_OVERHEAD = MESSAGE_HEADER.size + 2 * PARAMETER_HEADER.size + paddedLength(1)
+MAX_RESPONSE_APDU = 0xFFFF
+# Smallest MaxMsgSize taking the response to any short APDU, 256 bytes and SW1 SW2
+MIN_MSG_SIZE = APDU_RESP_OVERHEAD + paddedLength(256 + 2)
+
+
+def template(mID, params):
+    ''' Immutable wire bytes of a message that never changes, built once.
+    Each use copies it with bytearray(template), a single memcpy. '''
+    return bytes(buildMessage(mID, params))
+
+
+def atrTemplate(atr):
+    ''' TRANSFER_ATR_RESP template for a card, made when it is inserted '''
+    return template(messageName['TRANSFER_ATR_RESP'], [
+        (parameterName['ResultCode'], [RESULT_OK]),
+        (parameterName['ATR'], atr)])
+
+
+CONNECT_RESP_OK = template(messageName['CONNECT_RESP'], [
+    (parameterName['ConnectionStatus'], [CONNECTION_OK])])
+CONNECT_RESP_FAILED = template(messageName['CONNECT_RESP'], [
+    (parameterName['ConnectionStatus'], [CONNECTION_FAILED])])
+CONNECT_RESP_TOO_SMALL = template(messageName['CONNECT_RESP'], [
+    (parameterName['ConnectionStatus'], [CONNECTION_MSG_SIZE_TOO_SMALL]),
+    (parameterName['MaxMsgSize'], struct.pack('!H', MIN_MSG_SIZE))])
+DISCONNECT_RESP = template(messageName['DISCONNECT_RESP'], [])
+ERROR_RESP = template(messageName['ERROR_RESP'], [])
+DISCONNECT_IND = dict((kind, template(messageName['DISCONNECT_IND'], [
+    (parameterName['DisconnectionType'], [kind])])) for kind in (DISCONNECT_GRACEFUL,
+                                                                 DISCONNECT_IMMEDIATE))
+STATUS_IND = dict((status, template(messageName['STATUS_IND'], [
+    (parameterName['StatusChange'], [status])])) for status in xrange(STATUS_CARD_RECOVERED + 1))
+# Response to each of RESULT_REQUESTS, by (request ID, ResultCode)
+RESULTS = dict(((mID, code), template(mID + 1, [(parameterName['ResultCode'], [code])]))
+                for mID in RESULT_REQUESTS
+                for code in xrange(RESULT_OK, RESULT_NOT_SUPPORTED + 1))
+
+
+class RSAPFramer:
+    ''' Reassembles messages from an arbitrarily fragmented byte stream.
+
+    Parse state is kept between calls to feed(), so every byte is looked at
+    once however the stream is split, several pipelined messages in one
+    fragment are all returned, and bytes past the last complete message are
+    kept for the next fragment. '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buffer = bytearray()
+        # Offset just past the part of the current message parsed so far
+        self.cursor = 0
+        # Parameters of the current message still to be parsed, None until
+        # its header has arrived
+        self.remaining = None
+
+    def pending(self):
+        ''' Number of buffered bytes not yet returned as a message '''
+        return len(self.buffer)
+
+    def feed(self, data):
+        ''' Add a fragment and return the list of messages it completed '''
+        buf = self.buffer
+        buf += data
+        messages = []
+        start = 0
+        while True:
+            if self.remaining is None:
+                if len(buf) < start + MESSAGE_HEADER.size:
+                    break
+                _, self.remaining, _ = MESSAGE_HEADER.unpack_from(buf, start)
+                self.cursor = start + MESSAGE_HEADER.size
+            elif len(buf) < self.cursor:
+                break
+            elif self.remaining == 0:
+                messages.append(buf[start:self.cursor])
+                start = self.cursor
+                self.remaining = None
+            else:
+                if len(buf) < self.cursor + PARAMETER_HEADER.size:
+                    break
+                _, paramLen = PARAMETER_HEADER.unpack_from(buf, self.cursor)
+                self.cursor += PARAMETER_HEADER.size + paddedLength(paramLen)
+                self.remaining -= 1
+        if start:
+            del buf[:start]
+            self.cursor -= start
+        return messages
+
+
+class RSAPMessageProtocol:
+    messageID = messageID
+    messageName = messageName
+    parameterID = parameterID
+    parameterName = parameterName
+
+    def __init__(self):
+        self.steps = [
+            [messageName['CONNECT_REQ']],
+            [messageName['TRANSFER_ATR_REQ']],
+            # Once connected, anything the client may send
+            [messageName[name] for name in (
+                'CONNECT_REQ', 'DISCONNECT_REQ', 'TRANSFER_APDU_REQ', 'TRANSFER_ATR_REQ',
+                'POWER_SIM_OFF_REQ', 'POWER_SIM_ON_REQ', 'RESET_SIM_REQ',
+                'TRANSFER_CARD_READER_STATUS_REQ', 'SET_TRANSPORT_PROTOCOL_REQ')]
+        ]
+        self.currentStep = 0
+        # Negotiated by CONNECT_REQ, None while not connected
+        self.maxMsgSize = None
+
+    def isMessageComplete(self, message):
+        return messageLength(message) is not None
+
+    def getExpectedCommands(self):
+        return self.steps[self.currentStep]
+
+    def advanceStep(self):
+        if (self.currentStep < len(self.steps)-1):
+            self.currentStep = self.currentStep + 1
+
+    def expectedCommand(self, message):
+        return message[0] in self.steps[self.currentStep]
+
+    def printMessage(self, message):
+        print describeMessage(message)
+        return True
+
+    def decodeCONNECT_REQ(self, message):
+        if message[0] != messageName['CONNECT_REQ']:
+            raise ValueError('Not a CONNECT_REQ message')
+        value = getParameter(message, parameterName['MaxMsgSize'])
+        if value is not None:
+            if len(value) != 2:
+                raise ValueError('MaxMsgSize of %d bytes' % len(value))
+            return struct.unpack_from('!H', value)[0]
+
+    def generateCONNECT_RESP(self, connect_req):
+        ''' Accepts the client's MaxMsgSize, or refuses it with the smallest
+        one that can be used if it is too small for a short APDU's response.
+        Only a successful CONNECT sets maxMsgSize. '''
+        maxMsgSize = self.decodeCONNECT_REQ(connect_req)
+        if maxMsgSize is None:
+            maxMsgSize = MAX_MSG_SIZE
+        if maxMsgSize < MIN_MSG_SIZE:
+            self.maxMsgSize = None
+            return bytearray(CONNECT_RESP_TOO_SMALL)
+        self.maxMsgSize = maxMsgSize
+        return bytearray(CONNECT_RESP_OK)
+
+    def maxResponseData(self):
+        ''' Most response data bytes, besides SW1 SW2, a TRANSFER_APDU_RESP to
+        the client can carry '''
+        room = MAX_MSG_SIZE if self.maxMsgSize is None else self.maxMsgSize
+        return min((room - APDU_RESP_OVERHEAD) & ~3, MAX_RESPONSE_APDU) - 2
+
+    def generateSTATUS_IND(self, statusChange=STATUS_CARD_RESET):
+        return bytearray(STATUS_IND[statusChange])
+
+    def generateFailure(self, request, resultCode=RESULT_CARD_NOT_ACCESSIBLE):
+        ''' Response to request for when it cannot be carried out, e.g.
+        because the server cannot be reached '''
+        mID = request[0]
+        if mID == messageName['CONNECT_REQ']:
+            return bytearray(CONNECT_RESP_FAILED)
+        if mID == messageName['DISCONNECT_REQ']:
+            return bytearray(DISCONNECT_RESP)
+        if mID in RESULT_REQUESTS:
+            return self.generateResult(request, resultCode)
+        return bytearray(ERROR_RESP)
+
+    def generateResult(self, request, resultCode=RESULT_OK):
+        ''' Response to one of RESULT_REQUESTS carrying only a ResultCode '''
+        response = RESULTS.get((request[0], resultCode))
+        if response is None:
+            return buildMessage(request[0] + 1, [(parameterName['ResultCode'], [resultCode])])
+        return bytearray(response)
+
+    def generateDISCONNECT_IND(self, disconnectionType=DISCONNECT_GRACEFUL):
+        return bytearray(DISCONNECT_IND[disconnectionType])
+
+    def generateDISCONNECT_RESP(self):
+        return bytearray(DISCONNECT_RESP)
+
+    def generateERROR_RESP(self):
+        return bytearray(ERROR_RESP)
+
+    def generateTRANSFER_CARD_READER_STATUS_RESP(self, status):
+        return buildMessage(messageName['TRANSFER_CARD_READER_STATUS_RESP'], [
+            (parameterName['ResultCode'], [RESULT_OK]),
+            (parameterName['CardReaderStatus'], [status])])
+
+    def decodeSET_TRANSPORT_PROTOCOL_REQ(self, message):
+        value = getParameter(message, parameterName['TransportProtocol'])
+        if value is not None:
+            if len(value) != 1:
+                raise ValueError('TransportProtocol of %d bytes' % len(value))
+            return bytearray(value)[0]
+
+    def generateTRANSFER_APDU_RESP(self, apdu):
+        if len(apdu) - 2 > self.maxResponseData():
+            # Longer than the client said it can take
+            return self.generateResult([messageName['TRANSFER_APDU_REQ']], RESULT_NO_REASON)
+        return buildMessage(messageName['TRANSFER_APDU_RESP'], [
+            (parameterName['ResultCode'], [RESULT_OK]),
+            (parameterName['ResponseAPDU'], apdu)])
+
+    def extractAPDU_REQ(self, message):
+        if message[0] != messageName['TRANSFER_APDU_REQ']:
+            raise ValueError('Not a TRANSFER_APDU_REQ message')
+        for paramID, apduReq in parseMessage(message)[1]:
+            if paramID in (parameterName['CommandAPDU'], parameterName['CommandAPDU7816']):
+                return apduReq
+        raise ValueError('No CommandAPDU in TRANSFER_APDU_REQ')
+
+    def generateTRANSFER_APDU_REQ(self, apdu):
+        return buildMessage(messageName['TRANSFER_APDU_REQ'], [
+            (parameterName['CommandAPDU'], apdu)])
+
+    def extractAPDU_RESP(self, message):
+        if message[0] != messageName['TRANSFER_APDU_RESP']:
+            raise ValueError('Not a TRANSFER_APDU_RESP message')
+        return getParameter(message, parameterName['ResponseAPDU'])
+
+    def generateTRANSFER_ATR_RESP(self, atr):
+        return bytearray(atrTemplate(atr))
+
+    def addParameterPadding(self, parameter):
+        padded = bytearray(paddedLength(len(parameter)))
+        padded[:len(parameter)] = parameter
+        return padded
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Order in which a card runs the jobs queued for it.
+
+In arrival order, one client's bulk reads (a phonebook or SMS sweep, the
+relay's read-ahead) hold up another client's authentication for as long as
+they take, and a network attach fails when RUN GSM ALGORITHM/AUTHENTICATE is
+not answered in time. CardScheduler puts each command in a lane by its INS
+byte, with a deadline counted from when it was queued:
+
+    auth      RUN GSM ALGORITHM, AUTHENTICATE (88, 89)       0.2 s
+    normal    anything else                                   1 s
+    bulk      READ BINARY, READ RECORD, SEARCH RECORD         5 s
+
+Of the oldest job of each client, the one with the earliest deadline picks
+the lane, and the clients with a job of that lane next take turns in it: the
+one whose job ran longest ago goes first. A client's own jobs always run in
+the order it sent them. A client in the middle of a sweep gets one job in
+turn with every other client waiting in the same lane, and none in a more
+urgent one, while its bulk reads still run whenever nothing else waits, or
+once they have waited out their deadline. Deadlines only order the lanes:
+within a lane, a client waits for at most one job of each other client.
+
+A job can only run ahead of others if the card can be put back in the state
+it expects: the file selected before it, as the server's cache followed it
+(job.before), selected again when another client's job changed it. While
+jobs are queued for which that is not known (powering and resetting the
+card, a GET RESPONSE to the command before it, commands on the record
+pointer, which the SELECTs putting the card back reset, logical channels,
+paths the cache lost track of, and every job when the cache is off), the
+queue runs in arrival order. So do the jobs queued after a SELECT fails on
+the card, or the card fails, until the front-end has taken in that the
+selection it expected is not the card's.
+"""
+
+import time
+import threading
+
+import metrics
+from apducache import selectPath
+
+INS_GET_RESPONSE = 0xC0
+INS_SELECT = 0xA4
+INS_READ_RECORD = 0xB2
+INS_UPDATE_RECORD = 0xDC
+INS_SEARCH_RECORD = 0xA2
+
+AUTH = 'auth'
+NORMAL = 'normal'
+BULK = 'bulk'
+
+LANES = {
+    0x88: AUTH,     # RUN GSM ALGORITHM, AUTHENTICATE
+    0x89: AUTH,     # AUTHENTICATE, odd instruction
+    0xB0: BULK,     # READ BINARY
+    0xB2: BULK,     # READ RECORD
+    0xA2: BULK,     # SEARCH RECORD
+}
+
+# Seconds from being queued by which a job of each lane should have run
+DEADLINES = {
+    AUTH: 0.2,
+    NORMAL: 1.0,
+    BULK: 5.0,
+}
+
+CARD_WAIT = metrics.histogram('rsap_card_wait_seconds',
+                              "Time a command is queued before the card runs it, by reader "
+                              "and lane", ('reader', 'lane'))
+DEADLINE_MISSES = metrics.counter('rsap_card_deadline_misses_total',
+                                  "Commands the card ran after their deadline, by reader and "
+                                  "lane", ('reader', 'lane'))
+
+
+def laneOf(apdu):
+    return LANES.get(apdu[1], NORMAL) if len(apdu) >= 4 else NORMAL
+
+
+def usesRecordPointer(apdu):
+    ''' Whether apdu works relative to the current record: READ RECORD and
+    UPDATE RECORD of the current, next or previous record, and SEARCH
+    RECORD (SEEK on a GSM SIM) from the current, next or previous one '''
+    p1, p2 = apdu[2], apdu[3]
+    if apdu[1] in (INS_READ_RECORD, INS_UPDATE_RECORD):
+        mode = p2 & 0x07
+        return mode in (0x02, 0x03) or (mode == 0x04 and p1 == 0)
+    if apdu[1] == INS_SEARCH_RECORD:
+        if apdu[0] & 0xF0 == 0xA0:
+            return p2 & 0x0F in (0x02, 0x03)
+        # P1 = 00 starts from the current record, and an enhanced search
+        # can start from the next or previous one
+        enhanced = (p2 & 0x07) == 0x06 and len(apdu) > 5 and apdu[5] & 0x07 in (0x06, 0x07)
+        return p1 == 0 or enhanced
+    return False
+
+
+def restoreSelection(job):
+    ''' SELECTs putting the card in the state job expects, or None if the
+    job has to run in whatever state the jobs before it left the card '''
+    if job.before is None or not job.apdus:
+        return None
+    apdu = job.apdus[0]
+    # Logical channels other than the basic one have a selection of their
+    # own, and a GET RESPONSE answers the command just before it
+    if len(apdu) < 4 or apdu[0] & 0x43 or apdu[1] == INS_GET_RESPONSE:
+        return None
+    # Up to the job's own first SELECT, which resets the record pointer
+    # anyway
+    for command in job.apdus:
+        if len(command) < 4 or command[1] == INS_SELECT:
+            break
+        if usesRecordPointer(command):
+            return None
+    return selectPath(job.before, apdu[0])
+
+
+class CardScheduler:
+    ''' Queue of the CardJobs for the card in one reader. put() from the
+    front-end, get() from the card's thread, which blocks until there is a
+    job and returns the one to run next. Jobs have a session, the client
+    they are for (None for the server's own), and the paths the card is
+    expected to have selected before and after them. '''
+    def __init__(self, reader=''):
+        self.condition = threading.Condition()
+        # In the order they were put
+        self.jobs = []
+        # Whether the card's selection is not the one the front-end
+        # expects, since a SELECT it queued failed
+        self.lost = False
+        # Turn at which each session with jobs queued last had one run
+        self.served = {}
+        self.turn = 0
+        self.waits = dict((lane, CARD_WAIT.labels(reader, lane)) for lane in DEADLINES)
+        self.misses = dict((lane, DEADLINE_MISSES.labels(reader, lane)) for lane in DEADLINES)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def put(self, job):
+        job.queued = time.time()
+        job.lane = laneOf(job.apdus[-1]) if job.apdus else NORMAL
+        job.deadline = job.queued + DEADLINES[job.lane]
+        with self.condition:
+            if self.lost:
+                job.before = None
+            job.restore = restoreSelection(job)
+            self.jobs.append(job)
+            self.condition.notify()
+
+    def selectionLost(self):
+        ''' From the card's thread, when the card is not where the jobs
+        queued expect it: they run in arrival order, as do the jobs put
+        until selectionFound() '''
+        with self.condition:
+            self.lost = True
+            for job in self.jobs:
+                job.before = job.restore = None
+
+    def selectionFound(self):
+        ''' From the front-end, once it stopped expecting the selection
+        that was lost '''
+        with self.condition:
+            self.lost = False
+
+    def get(self):
+        with self.condition:
+            while not self.jobs:
+                self.condition.wait()
+            job = self.pick()
+            self.jobs.remove(job)
+            self.turn += 1
+            if any(queued.session == job.session for queued in self.jobs):
+                self.served[job.session] = self.turn
+            else:
+                self.served.pop(job.session, None)
+        now = time.time()
+        self.waits[job.lane].observe(now - job.queued)
+        if now > job.deadline:
+            self.misses[job.lane].inc()
+        return job
+
+    def pick(self):
+        ''' Of each session's oldest job, the one served longest ago in
+        the lane of the earliest deadline, if all the jobs can be moved '''
+        first = {}
+        for job in self.jobs:
+            if job.session is None or job.restore is None:
+                # The jobs before it have to leave the card as they would
+                # in arrival order
+                return self.jobs[0]
+            if job.session not in first:
+                first[job.session] = job
+        lane = min(first.itervalues(), key=lambda job: job.deadline).lane
+        return min((job for job in first.itervalues() if job.lane == lane),
+                   key=lambda job: (self.served.get(job.session, 0), job.deadline))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Per-connection RSAP state for the servers.
+
+Each peer (ZMQ identity, or D-Bus sender) gets its own Session with its own
+framer and protocol state machine, so one client's CONNECT_REQ or half-sent
+message cannot disturb another's.
+"""
+
+import time
+from collections import OrderedDict
+
+from rsap import RSAPMessageProtocol, RSAPFramer
+
+
+class Session:
+    def __init__(self, key):
+        self.key = key
+        self.framer = RSAPFramer()
+        self.rsap = RSAPMessageProtocol()
+
+
+class SessionTable:
+    ''' Mapping of peer key to value, bounded to maxSessions entries by
+    evicting the least recently used one, with entries idle for longer than
+    idleTimeout seconds dropped as well. onEvict(key, value) is called for
+    every entry removed that way. '''
+    def __init__(self, maxSessions=64, idleTimeout=3600, onEvict=None):
+        self.maxSessions = maxSessions
+        self.idleTimeout = idleTimeout
+        self.onEvict = onEvict
+        self.entries = OrderedDict()
+        self.lastUsed = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def lookup(self, key, factory=None, now=None):
+        ''' Value for key, marking it as just used. If there is none, it is
+        created with factory(key) when a factory is given, else None is
+        returned. '''
+        if now is None:
+            now = time.time()
+        self.expire(now)
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+            self.lastUsed[key] = now
+        elif factory is not None:
+            value = factory(key)
+            self.insert(key, value, now)
+        return value
+
+    def insert(self, key, value, now=None):
+        if now is None:
+            now = time.time()
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        self.lastUsed[key] = now
+        while len(self.entries) > self.maxSessions:
+            self.evict(next(iter(self.entries)))
+
+    def clear(self):
+        self.entries.clear()
+        self.lastUsed.clear()
+
+    def remove(self, key):
+        self.lastUsed.pop(key, None)
+        return self.entries.pop(key, None)
+
+    def evict(self, key):
+        value = self.remove(key)
+        if self.onEvict is not None:
+            self.onEvict(key, value)
+
+    def expire(self, now=None):
+        ''' Drop idle entries. They are kept in order of use, so only the
+        oldest ones need looking at. '''
+        if now is None:
+            now = time.time()
+        while self.entries:
+            key = next(iter(self.entries))
+            if now - self.lastUsed[key] <= self.idleTimeout:
+                break
+            self.evict(key)
+
+    def values(self):
+        return self.entries.values()
+
+    def items(self):
+        return self.entries.items()
+
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 import sys
+import time
 from traceback import print_exc
 from smartcard.util import toHexString
-import numpy as np
+
+import transport
 
 import zmq
 import zmq.auth
@@ -12,6 +14,12 @@ import logging
 import os
 from zmq.auth.thread import ThreadAuthenticator
 
+SERVER_ADDRESS = 'tcp://192.168.0.20:9000'
+
+# Seconds to wait for each reply, and how many times a request is sent
+REPLY_TIMEOUT = 5.0
+ATTEMPTS = 4
+
 HWHEADER = [0x05, 0x01, 0x00, 0x00, 0x04, 0x00, 0x00]
 commands = [
     [00, 01, 00, 00, 00, 00, 00, 02, 01, 0x2C, 00, 00],
@@ -81,6 +89,12 @@ def run():
     auth.configure_curve(domain='*', location=public_keys_dir)
 
     client = ctx.socket(zmq.REQ)
+    # Give up on a reply after a while and send the request again, rather
+    # than wait forever for one that was lost
+    client.setsockopt(zmq.REQ_RELAXED, 1)
+    client.setsockopt(zmq.REQ_CORRELATE, 1)
+    client.setsockopt(zmq.RCVTIMEO, int(REPLY_TIMEOUT * 1000))
+    client.linger = 0
 
     # We need two certificates, one for the client and one for
     # the server. The client must know the server's public key
@@ -94,12 +108,27 @@ def run():
     server_public, _ = zmq.auth.load_certificate(server_public_file)
     # The client must know the server's public key to make a CURVE connection.
     client.curve_serverkey = server_public
-    client.connect('tcp://192.168.0.20:9000')
+    address = sys.argv[sys.argv.index('--server') + 1] if '--server' in sys.argv else SERVER_ADDRESS
+    client.connect(address)
 
-    for command in commands:
+    binary = '--json' not in sys.argv
+    iccid = sys.argv[sys.argv.index('--sim') + 1] if '--sim' in sys.argv else None
+    for seq, command in enumerate(commands):
         print "<", toHexString(command)
-        client.send_json(command)
-        apduResponse = client.recv_json()
+        request = transport.encode(bytearray(command), seq, binary, iccid=iccid)
+        backoff = 0.1
+        for attempt in xrange(ATTEMPTS):
+            client.send_multipart(request)
+            try:
+                apduResponse, _, _ = transport.decode(client.recv_multipart())
+                break
+            except zmq.Again:
+                logging.warning("No reply in %.1f s, sending again", REPLY_TIMEOUT)
+                time.sleep(backoff)
+                backoff *= 2
+        else:
+            logging.critical("The server does not answer")
+            sys.exit(1)
         bArrResp = list(bytearray(apduResponse))
         print ">", toHexString(bArrResp)
         # print ">", toHexString(apduResponse)
@@ -2,287 +2,845 @@
 
 import threading
 import Queue
-import math
-import numpy as np
+import time
+from collections import deque
 
 from smartcard.CardType import AnyCardType
 from smartcard.CardRequest import CardRequest
-from smartcard.CardConnectionObserver import CardConnectionObserver
-from smartcard.CardConnectionObserver import ConsoleCardConnectionObserver
-from smartcard.util import toHexString
-
-from smartcard.sw.ErrorCheckingChain import ErrorCheckingChain
-from smartcard.sw.ISO7816_4ErrorChecker import ISO7816_4ErrorChecker
-from smartcard.sw.ISO7816_8ErrorChecker import ISO7816_8ErrorChecker
-from smartcard.sw.SWExceptions import SWException, WarningProcessingException
+from smartcard.System import readers as listReaders
+from smartcard.Exceptions import CardConnectionException, NoCardException
+from smartcard.Exceptions import CardRequestTimeoutException
+
+from rsap import HexDump, MessageDump, atrTemplate, buildMessage, messageName, messageID
+from rsap import RESULT_OK, RESULT_NO_REASON, RESULT_CARD_ALREADY_OFF, RESULT_CARD_ALREADY_ON
+from rsap import RESULT_NOT_SUPPORTED, READER_PRESENT, READER_CARD_PRESENT, READER_CARD_POWERED
+from rsap import RESULT_CARD_REMOVED, STATUS_CARD_RESET, STATUS_CARD_INSERTED
+from rsap import STATUS_CARD_NOT_ACCESSIBLE, STATUS_CARD_RECOVERED, STATUS_CARD_REMOVED
+from rsap import RSAPMessageProtocol
+import transport
+import tracing
+import metrics
+from session import Session, SessionTable
+from apducache import FileCache, MF, INS_SELECT, isSuccess, limitResponseLength
+from transmit import TransmitEngine
+from scheduler import CardScheduler
+import cardmonitor
+import readiness
+from keystore import KeyStore
 
 import zmq
 import zmq.auth
 import sys
 import logging
 import os
+import argparse
 from zmq.auth.thread import ThreadAuthenticator
 
-class RSAPMessageProtocol:
-    # Message is of a format:
-    # |  1  |  1   |    2   |        varies          |
-    #  msgID #param reserved     payload 
-    #
-    # Payload (parameter) looks like
-    # |  1  |  1  |    2    |     varies      | 0-3 |  
-    #  param  rsv. paramLen    parameter value  padding
-    #   ID
-    # The length of each parameter will be a multiple of 4 bytes - use padding to reach that
-    def __init__(self):
-        self.messageID = {
-            0x00: 'CONNECT_REQ',
-            0x01: 'CONNECT_RESP',
-            0x02: 'DISCONNECT_REQ',
-            0x03: 'DISCONNECT_RESP',
-            0x04: 'DISCONNECT_IND',
-            0x05: 'TRANSFER_APDU_REQ',
-            0x06: 'TRANSFER_APDU_RESP',
-            0x07: 'TRANSFER_ATR_REQ',
-            0x08: 'TRANSFER_ATR_RESP',
-            0x09: 'POWER_SIM_OFF_REQ',
-            0x0A: 'POWER_SIM_OFF_RESP',
-            0x0B: 'POWER_SIM_ON_REQ',
-            0x0C: 'POWER_SIM_ON_RESP',
-            0x0D: 'RESET_SIM_REQ',
-            0x0E: 'RESET_SIM_RESP',
-            0x0F: 'TRANSFER_CARD_READER_STATUS_REQ',
-            0x10: 'TRANSFER_CARD_READER_STATUS_RESP',
-            0x11: 'STATUS_IND',
-            0x12: 'ERROR_RESP',
-            0x13: 'SET_TRANSPORT_PROTOCOL_REQ',
-            0x14: 'SET_TRANSPORT_PROTOCOL_RESP'
-        }
-        self.messageName = dict((v,k) for k, v in self.messageID.iteritems())
-        self.parameterID = {
-            0x00: 'MaxMsgSize',
-            0x01: 'ConnectionStatus',
-            0x02: 'ResultCode',
-            0x03: 'DisconnectionType',
-            0x04: 'CommandAPDU',
-            0x10: 'CommandAPDU7816',
-            0x05: 'ResponseAPDU',
-            0x06: 'ATR',
-            0x07: 'CardReaderStatus',
-            0x08: 'StatusChange',
-            0x09: 'TransportProtocol'
-        }
-        self.parameterName = dict((v,k) for k, v in self.parameterID.iteritems())
-        self.msgReserved = [0x00, 0x00]
-        self.paramReserved = [0x00]
-
-        self.steps = [
-            [self.messageName['CONNECT_REQ']],
-            [self.messageName['TRANSFER_ATR_REQ']],
-            [self.messageName['TRANSFER_APDU_REQ']]
-        ]
-        self.currentStep = 0
-
-    def isMessageComplete(self, message):
-        if (len(message) < 4):
-            return False
-        mID = message[0]
-        parameters = message[1]
-        if parameters == 0:
-            return True
-        currentPos = 4
-        for i in range(parameters):
-            if (len(message) < currentPos+4):
-                return False
-            # Length of the parameter as encoded in the message
-            paramLen = (message[currentPos+2] << 8) + message[currentPos+3]
-            # Payload (parameter + padding) length has to be a multiple of 4
-            fullLen = int(math.ceil(paramLen/float(4))*4)
-            if (len(message) < currentPos+4+fullLen):
-                return False
-            # Move onto the next parameter
-            currentPos = currentPos+4+fullLen
-        return True
-
-    def getExpectedCommands(self):
-        return self.steps[self.currentStep]
-
-    def advanceStep(self):
-        if (self.currentStep < len(self.steps)-1):
-            self.currentStep = self.currentStep + 1
-
-    def expectedCommand(self, message):
-        currentlyExpected = self.steps[self.currentStep]
-        for expected in currentlyExpected:
-            if expected == message[0]:
-                return True
-        return False
-
-
-    def printMessage(self, message):
-        print toHexString(message)
-        mID = message[0]
-        parameters = message[1]
-        print self.messageID[mID], ", ", parameters, " parameters:"
-        currentPos = 4
-        for i in range(parameters):
-            # Length of the parameter as encoded in the message
-            paramLen = (message[currentPos+2] << 8) + message[currentPos+3]
-            # Payload (parameter + padding) length has to be a multiple of 4
-            fullLen = int(math.ceil(paramLen/float(4))*4)
-            paramVal = message[currentPos+4:currentPos+4+paramLen]
-            print self.parameterID[message[currentPos]], " = ", toHexString(paramVal), "(length =", paramLen, ")"
-            # Move onto the next parameter
-            currentPos = currentPos+4+fullLen
+MESSAGES = metrics.counter('rsap_messages_total',
+                           "RSAP messages received from clients, by reader and type",
+                           ('reader', 'type'))
+REQUESTS = metrics.histogram('rsap_request_seconds',
+                             "Time taken to answer a client's fragment, by reader",
+                             ('reader',))
+SESSIONS = metrics.gauge('rsap_sessions', "Client sessions held, by reader", ('reader',))
+QUEUED = metrics.gauge('rsap_requests_queued',
+                       "Requests passed on to a card and not answered yet, by reader",
+                       ('reader',))
+
+# Seconds between sweeps of idle sessions when no request comes in
+HOUSEKEEPING_INTERVAL = 60
+# Seconds a reader is waited on for a card, at start or once told of one
+CARD_TIMEOUT = 10
+# Sent by a CardWorker once its Server is set up, before any finished job
+STARTED = b'started'
+
+def readICCID(connection):
+    ''' ICCID of the card in connection, read from EF_ICCID (3F00/2FE2).
+    Tries UICC commands first, then GSM class A0. '''
+    for cla, p2 in [(0x00, 0x0C), (0xA0, 0x00)]:
+        ok = True
+        for fid in [[0x3F, 0x00], [0x2F, 0xE2]]:
+            resp, sw1, sw2 = connection.transmit([cla, 0xA4, 0x00, p2, 0x02] + fid)
+            if sw1 not in (0x90, 0x61, 0x9F):
+                ok = False
+                break
+        if not ok:
+            continue
+        resp, sw1, sw2 = connection.transmit([cla, 0xB0, 0x00, 0x00, 0x0A])
+        if sw1 == 0x90:
+            # BCD with swapped nibbles, padded with F
+            return ''.join(['%X%X' % (b & 0x0F, b >> 4) for b in resp]).rstrip('F')
+    return None
+
+class CardJob:
+    ''' APDUs to send to the card, in order, and finish(response) to make
+    the RSAP reply from the card's response to the last one. Set once the
+    card has answered: response, and status, the StatusChange to tell the
+    clients about if the card was lost on the way.
+
+    before and after are the paths the card has selected before and after
+    the job, as far as the cache follows them, so the job can be run out of
+    order (see scheduler.py); session is the client it is for. lost is set
+    when the card did not end up on after, because a SELECT failed or the
+    card did. '''
+    def __init__(self, apdus, finish, before=None, after=None):
+        self.apdus = apdus
+        self.finish = finish
+        self.before = before
+        self.after = after
+        self.session = None
+        self.response = None
+        self.status = None
+        self.lost = False
+        # Set by the Reply the job is part of, if any
+        self.reply = None
+
+    def run(self, transmit):
+        for apdu in self.apdus:
+            response = transmit(apdu)
+        return response
+
+class CardControl(CardJob):
+    ''' Powering the card off or on, or resetting it: action() instead of
+    APDUs, with finish(True) once it is done '''
+    def __init__(self, action, finish, after=None):
+        CardJob.__init__(self, [], finish, after=after)
+        self.action = action
+
+    def run(self, transmit):
+        self.action()
         return True
 
-    def decodeCONNECT_REQ(self, message):
-        if (self.messageID[message[0]] != 'CONNECT_REQ'):
-            raise NameError('Not a CONNECT_REQ message')
-        if (self.parameterID[message[4]] == 'MaxMsgSize'):
-            return message[6]<<8+message[7]
-
-    def generateCONNECT_RESP(self, connect_req):
-        mID = self.messageName['CONNECT_RESP']
-        params = 1
-        paramID = self.parameterName['ConnectionStatus']
-        paramLen = 1
-        #MaxMsgSize = decodeCONNECT_REQ(connect_req)
-        #pValue = [MaxMsgSize>>4, MaxMsgSize&0x1111]
-        pValue = [0x00]
-        parameter = [paramID]+self.paramReserved+[0x00, paramLen]+pValue
-        return [mID]+[params]+self.msgReserved+self.addParameterPadding(parameter)
-
-    def generateSTATUS_IND(self):
-        mID = self.messageName['STATUS_IND']
-        params = 1
-        paramID = self.parameterName['StatusChange']
-        paramLen = 1
-        StatusChange = 0x01
-        pValue = [StatusChange]
-        parameter = [paramID]+self.paramReserved+[0x00, paramLen]+pValue
-        return [mID]+[params]+self.msgReserved+self.addParameterPadding(parameter)
-
-    def generateTRANSFER_APDU_RESP(self, apdu):
-        mID = self.messageName['TRANSFER_APDU_RESP']
-        params = 2
-        param1ID = self.parameterName['ResultCode']
-        param1Len = 1
-        #TODO
-        ResultCode = 0x00
-        parameter1 = self.addParameterPadding([param1ID]+self.paramReserved+[0x00, param1Len]+[ResultCode])
-        param2ID = self.parameterName['ResponseAPDU']
-        param2Len = len(apdu)
-        parameter2 = self.addParameterPadding([param2ID]+self.paramReserved+[param2Len>>8, param2Len&0xFF]+apdu)
-        return [mID]+[params]+self.msgReserved+parameter1+parameter2
-
-    def extractAPDU_REQ(self, message):
-        if (self.messageID[message[0]] != 'TRANSFER_APDU_REQ'):
-            raise NameError('Not a TRANSFER_APDU_REQ message')
-        if (self.parameterID[message[4]] == 'CommandAPDU' or self.parameterID[message[4]] == 'CommandAPDU7816'):
-            length = (message[6] << 8) + message[7]
-            apduReq = message[8:8+length]
-            return apduReq
-
-    def generateTRANSFER_ATR_RESP(self, atr):
-        mID = self.messageName['TRANSFER_ATR_RESP']
-        params = 2
-        param1ID = self.parameterName['ResultCode']
-        param1Len = 1
-        #TODO
-        ResultCode = 0x00
-        parameter1 = self.addParameterPadding([param1ID]+self.paramReserved+[0x00, param1Len]+[ResultCode])
-        param2ID = self.parameterName['ATR']
-        param2Len = len(atr)
-        print "ATR length=", param2Len, "or [", param2Len>>8, param2Len&0xFF,"]"
-        parameter2 = self.addParameterPadding([param2ID]+self.paramReserved+[param2Len>>8, param2Len&0xFF]+atr)
-        return [mID]+[params]+self.msgReserved+parameter1+parameter2
-
-    def addParameterPadding(self, parameter):
-        needLength = int(math.ceil(len(parameter)/float(4))*4)
-        for i in range(len(parameter), needLength):
-            parameter = parameter + [0x00]
-        return parameter
-    
-
-
-
-
-
 class Server():
-    def __init__(self):
-        cardtype = AnyCardType()
-        cardrequest = CardRequest(timeout=10, cardType=cardtype)
-        print "waiting for card"
-        self.cardservice = cardrequest.waitforcard()
-        # errorchain=[]
-        # errorchain=[ ErrorCheckingChain( errorchain, ISO7816_8ErrorChecker() ),
-        #              ErrorCheckingChain( errorchain, ISO7816_4ErrorChecker() ) ]
-        # self.cardservice.connection.setErrorCheckingChain( errorchain )
-        observer=ConsoleCardConnectionObserver()
-        self.cardservice.connection.addObserver( observer )
-        print "Connecting cardservice"
-        self.cardservice.connection.connect()
-
-        self.rsap = RSAPMessageProtocol()
-
-        self.buffer = []
-        self.state = "CONNECT_REQ"
+    ''' RSAP for the card in one reader. Connecting to the card happens
+    here, when it is inserted; after that the card is only used through
+    self.card, from the thread that runs CardJobs, while handle() and the
+    sessions and cache it uses belong to the front-end's thread.
+
+    The reader may be empty, for cardTimeout seconds at start or once the
+    card is taken out: requests that need the card are then refused as
+    "card removed" until insertCard() connects to a new one. '''
+    def __init__(self, reader=None, maxSessions=64, idleTimeout=3600, cache=True,
+                 cardservice=None, trace=None, cardTimeout=CARD_TIMEOUT):
+        self.reader = str(reader) if reader is not None else None
+        self.trace = trace
+        self.cardservice = None
+        self.card = None
+        self.iccid = None
+        # Whether there is a card, and whether it is powered as the clients
+        # last asked for, only changed from the front-end
+        self.present = False
+        self.powered = False
+        # Path the card has selected once the jobs submitted so far have
+        # run, None when not known
+        self.cardPath = None
+        if cardservice is None:
+            logging.info("Waiting for card in %s", reader or "any reader")
+            try:
+                cardservice = self.cardRequest(reader, cardTimeout).waitforcard()
+            except CardRequestTimeoutException:
+                if reader is None:
+                    raise
+                logging.warning("No card in %s yet", reader)
+        if cardservice is not None:
+            self.connectCard(cardservice)
+            self.present = self.powered = True
+
+        self.sessions = SessionTable(maxSessions, idleTimeout)
+        # Static files are served from memory, unless caching is disabled
+        self.cache = FileCache()
+        self.useCache = cache
+        self.cache.exportMetrics(self.reader)
+        SESSIONS.labels(self.reader).setFunction(lambda: len(self.sessions))
+        self.latency = REQUESTS.labels(self.reader)
+        self.handlers = {
+            messageName['CONNECT_REQ']: self.onConnect,
+            messageName['DISCONNECT_REQ']: self.onDisconnect,
+            messageName['TRANSFER_ATR_REQ']: self.onTransferATR,
+            messageName['TRANSFER_APDU_REQ']: self.onTransferAPDU,
+            messageName['POWER_SIM_OFF_REQ']: self.onPowerOff,
+            messageName['POWER_SIM_ON_REQ']: self.onPowerOn,
+            messageName['RESET_SIM_REQ']: self.onReset,
+            messageName['TRANSFER_CARD_READER_STATUS_REQ']: self.onReaderStatus,
+            messageName['SET_TRANSPORT_PROTOCOL_REQ']: self.onSetTransportProtocol,
+        }
 
-    def process(self, inCommand):
-        inMessage = list(bytearray(inCommand))
-        self.buffer += inMessage
-        print "Current buffer", toHexString(self.buffer)
-        if not self.rsap.isMessageComplete(self.buffer):
-            print "Message incomplete, waiting"
+    def cardRequest(self, reader, timeout):
+        cardtype = AnyCardType()
+        if reader is None:
+            return CardRequest(timeout=timeout, cardType=cardtype)
+        return CardRequest(timeout=timeout, cardType=cardtype, readers=[reader])
+
+    def connectCard(self, cardservice):
+        ''' Connect to the card of cardservice, in place of the last one.
+        Runs on the card's thread, the front-end then takes the card into
+        use with cardInserted(). '''
+        if self.cardservice is not None:
+            try:
+                self.cardservice.connection.disconnect()
+            except Exception as e:
+                logging.debug("Disconnecting from the old card: %s", e)
+        if tracing.debugging():
+            from smartcard.CardConnectionObserver import ConsoleCardConnectionObserver
+            observer=ConsoleCardConnectionObserver()
+            cardservice.connection.addObserver( observer )
+        cardservice.connection.connect()
+        self.iccid = readICCID(cardservice.connection)
+        if self.reader is None:
+            self.reader = str(cardservice.connection.getReader())
+        # Asked once: the ATR and its response stay the same while the card
+        # is in the reader
+        self.atr = cardservice.connection.getATR()
+        self.atrResponse = atrTemplate(self.atr)
+        logging.info("Card %s in %s", self.iccid, self.reader)
+        self.cardservice = cardservice
+        self.card = TransmitEngine(cardservice.connection, self.reader)
+
+    def insertCard(self, reader):
+        ''' connectCard() to the card just put in reader, on the card's thread '''
+        self.connectCard(self.cardRequest(reader, CARD_TIMEOUT).waitforcard())
+
+    def cardInserted(self):
+        ''' The card insertCard() connected to is there to be used '''
+        self.present = self.powered = True
+        self.forgetCard()
+
+    def cardRemoved(self):
+        self.present = self.powered = False
+        self.forgetCard()
+
+    def forgetCard(self):
+        ''' Drop what was known about the last card: its files, and the
+        clients' sessions, which have to connect to the new one '''
+        self.cache.reset()
+        self.cardPath = None
+        self.sessions.clear()
+
+    def unavailable(self):
+        ''' ResultCode refusing a request that needs the card, or None '''
+        if not self.present:
+            return RESULT_CARD_REMOVED
+        if not self.powered:
+            return RESULT_CARD_ALREADY_OFF
+        return None
+
+    def process(self, inCommand, key=None):
+        ''' Handle a fragment from the peer identified by key, sending what
+        it needs to the card straight away, and return the answer '''
+        start = time.time()
+        response = bytearray()
+        for part in self.handle(inCommand, key):
+            if isinstance(part, CardJob):
+                part = part.finish(part.run(self.card.transmit))
+            response += part
+        return self.answered(response, start, key)
+
+    def handle(self, inCommand, key=None):
+        ''' Handle a fragment from the peer identified by key. Returns the
+        parts of the answer, in order: RSAP messages, or CardJobs for those
+        that need the card. The answer is the concatenation of the parts,
+        to be passed to answered() once all are known. '''
+        logging.debug("Received fragment %s", HexDump(inCommand))
+        if self.trace is not None:
+            self.trace.record(tracing.IN, inCommand, key)
+        session = self.sessions.lookup(key, Session)
+        messages = session.framer.feed(inCommand)
+        if not messages:
+            logging.debug("Message incomplete, waiting (%d bytes buffered)", session.framer.pending())
             return []
-        print "Message complete"
-        message = self.buffer
-        self.buffer = []
-        self.rsap.printMessage(message)
-        if (not self.rsap.expectedCommand(message)):
-            print "Not an expected message!"
-
-        rsap = self.rsap
-
-        if (message[0] == rsap.messageName['CONNECT_REQ']):
-            print "Restart from CONNECT_REQ"
-            rsap.currentStep = 0
-
-        if (rsap.currentStep == 0):
-            response1 = rsap.generateCONNECT_RESP(message)
-            rsap.printMessage(response1)
-            # TODO: return this as well... somehow!
-            response2 = rsap.generateSTATUS_IND()
-            rsap.printMessage(response2)
+        return [self.processMessage(session, message) for message in messages]
+
+    def answered(self, response, start, key=None):
+        ''' Account for the answer to a fragment from the peer identified
+        by key that arrived at start '''
+        if self.trace is not None:
+            self.trace.record(tracing.OUT, response, key)
+        self.latency.observe(time.time() - start)
+        return response
+
+    def transmit(self, apdu, reply):
+        ''' reply(response) for the card's response to apdu, or a CardJob
+        to get it '''
+        def finish(response):
+            message = reply(response)
+            logging.debug("%s", MessageDump(message))
+            return message
+        if not self.useCache:
+            return CardJob([list(apdu)], finish)
+        response, token = self.cache.lookup(apdu)
+        if response is not None:
+            return finish(response)
+        def update(response):
+            self.cache.update(token, response)
+            return finish(response)
+        # Cached SELECTs go first, so the card has the file selected that
+        # the APDU expects
+        job = CardJob(self.cache.takePendingSelects() + [list(apdu)], update,
+                      self.cardPath, self.cache.path)
+        self.cardPath = self.cache.path
+        return job
+
+    def processMessage(self, session, message):
+        logging.debug("Message complete\n%s", MessageDump(message))
+        MESSAGES.labels(self.reader, messageID.get(message[0], '0x%02X' % message[0])).inc()
+        if not session.rsap.expectedCommand(message):
+            logging.warning("Not an expected message: %s", HexDump(message))
+        handler = self.handlers.get(message[0])
+        if handler is None:
+            return session.rsap.generateERROR_RESP()
+        try:
+            return handler(session.rsap, message)
+        except ValueError as e:
+            logging.warning("Bad message %s: %s", HexDump(message), e)
+            return session.rsap.generateERROR_RESP()
+
+    def onConnect(self, rsap, message):
+        if rsap.currentStep:
+            logging.info("Restart from CONNECT_REQ")
+        rsap.currentStep = 0
+        response1 = rsap.generateCONNECT_RESP(message)
+        logging.debug("%s", MessageDump(response1))
+        if rsap.maxMsgSize is None:
+            # Refused, the client may try again with the MaxMsgSize given
+            logging.warning("Client's MaxMsgSize too small: %s", HexDump(message))
+            return response1
+        response2 = rsap.generateSTATUS_IND(STATUS_CARD_RESET if self.present
+                                            else STATUS_CARD_REMOVED)
+        logging.debug("%s", MessageDump(response2))
+        rsap.advanceStep()
+        # Both in one answer, the modem reads them off the stream in turn
+        return response1 + response2
+
+    def onDisconnect(self, rsap, message):
+        rsap.currentStep = 0
+        return rsap.generateDISCONNECT_RESP()
+
+    def onTransferATR(self, rsap, message):
+        refused = self.unavailable()
+        if refused:
+            return rsap.generateResult(message, refused)
+        if rsap.currentStep == 1:
             rsap.advanceStep()
-            return response2
-
-        if (rsap.currentStep == 1):
-            response = rsap.generateTRANSFER_ATR_RESP(self.cardservice.connection.getATR())
-            rsap.printMessage(response)
-            rsap.advanceStep()
-            return response
-
-        if (rsap.currentStep == 2):
-            apduRequest = rsap.extractAPDU_REQ(message)
-            resp, sw1, sw2 = self.cardservice.connection.transmit(apduRequest)
-            apduResponse = resp + [sw1, sw2]
-            if sw1 == 0x61:
-                apdu = [0x00, 0xC0, 0x00, 0x00, sw2]
-                resp, sw1, sw2 = self.cardservice.connection.transmit(apdu)
-                apduResponse = resp + [sw1, sw2]
-            response = rsap.generateTRANSFER_APDU_RESP(apduResponse)
-            rsap.printMessage(response)
-            rsap.advanceStep()
-            return response
-
-        return []
-
-def run():
-    ''' Run secure server '''
+        return bytearray(self.atrResponse)
+
+    def onTransferAPDU(self, rsap, message):
+        refused = self.unavailable()
+        if refused:
+            return rsap.generateResult(message, refused)
+        apduRequest = limitResponseLength(bytearray(rsap.extractAPDU_REQ(message)),
+                                          rsap.maxResponseData())
+        return self.transmit(apduRequest, rsap.generateTRANSFER_APDU_RESP)
+
+    def onPowerOff(self, rsap, message):
+        refused = self.unavailable()
+        if refused:
+            return rsap.generateResult(message, refused)
+        self.powered = False
+        self.cache.resetSelection()
+        return self.control(self.card.powerOff, rsap, message)
+
+    def onPowerOn(self, rsap, message):
+        if not self.present:
+            return rsap.generateResult(message, RESULT_CARD_REMOVED)
+        if self.powered:
+            return rsap.generateResult(message, RESULT_CARD_ALREADY_ON)
+        self.powered = True
+        # Powering on selects the MF, as a reset does
+        self.cache.resetSelection((MF,))
+        return self.control(self.card.powerOn, rsap, message)
+
+    def onReset(self, rsap, message):
+        refused = self.unavailable()
+        if refused:
+            return rsap.generateResult(message, refused)
+        # Same card, so the cached files stay; the ATR is the one read when
+        # it was inserted
+        self.cache.resetSelection((MF,))
+        return self.control(self.card.reset, rsap, message)
+
+    def onReaderStatus(self, rsap, message):
+        status = READER_PRESENT
+        if self.present:
+            status |= READER_CARD_PRESENT
+        if self.powered:
+            status |= READER_CARD_POWERED
+        return rsap.generateTRANSFER_CARD_READER_STATUS_RESP(status)
+
+    def onSetTransportProtocol(self, rsap, message):
+        # The protocol is the one the reader negotiated with the card
+        logging.info("Transport protocol T=%s requested, not supported",
+                     rsap.decodeSET_TRANSPORT_PROTOCOL_REQ(message))
+        return rsap.generateResult(message, RESULT_NOT_SUPPORTED)
+
+    def control(self, action, rsap, message):
+        ''' CardControl running action(), answering message with its result '''
+        def finish(done):
+            return rsap.generateResult(message, RESULT_OK if done is True else RESULT_NO_REASON)
+        # The handler reset the selection as the action will
+        self.cardPath = self.cache.path
+        return CardControl(action, finish, self.cardPath)
+
+def splitEnvelope(frames):
+    ''' Split ROUTER frames into the routing envelope (up to and including
+    the empty delimiter) and the message frames '''
+    delimiter = frames.index(b'') + 1
+    return frames[:delimiter], frames[delimiter:]
+
+class Reply:
+    ''' Answer to one request, a single fragment or a batch of them.
+    fragments holds the parts that Server.handle() returned for each, and
+    send(responses) is called with the answer to each fragment once the
+    card has answered every CardJob among them. '''
+    def __init__(self, fragments, send):
+        self.fragments = fragments
+        self.send = send
+        self.missing = 0
+        for parts in fragments:
+            for index, part in enumerate(parts):
+                if isinstance(part, CardJob):
+                    part.reply, part.parts, part.index = self, parts, index
+                    self.missing += 1
+        if not self.missing:
+            self.finish()
+
+    def fill(self, job):
+        job.parts[job.index] = job.finish(job.response)
+        self.missing -= 1
+        if not self.missing:
+            self.finish()
+
+    def finish(self):
+        responses = []
+        for parts in self.fragments:
+            response = bytearray()
+            for part in parts:
+                response += part
+            responses.append(response)
+        self.send(responses)
+
+class CardWorker(threading.Thread):
+    ''' Runs the CardJobs for the card in one reader, one at a time in the
+    order its CardScheduler picks, so a slow card only holds up the
+    requests that need it, and a client's bulk reads do not hold up
+    another's authentication. Each finished job is signalled to the
+    front-end over an inproc PAIR socket, after STARTED once the card was
+    connected to (or not: server is then None). '''
+    def __init__(self, ctx, reader, index, serverArgs, cardservice=None):
+        threading.Thread.__init__(self, name='card-%d' % index)
+        self.setDaemon(True)
+        self.ctx = ctx
+        self.reader = reader
+        self.serverArgs = serverArgs
+        self.cardservice = cardservice
+        self.address = 'inproc://card-%d' % index
+        # Front-end end of the pipe, only used from the front-end thread
+        self.pipe = ctx.socket(zmq.PAIR)
+        self.pipe.bind(self.address)
+        self.server = None
+        # Last card event seen while starting, only used from the front-end
+        self.pending = None
+        self.clients = 0
+        # StatusChange last pushed to the clients, None while the card works
+        self.status = None
+        self.jobs = CardScheduler(str(reader))
+        # Finished jobs, in the order they finished
+        self.done = Queue.Queue()
+        # Jobs submitted and not finished yet, oldest first, only used from
+        # the front-end thread
+        self.submitted = deque()
+
+    def submit(self, job):
+        self.submitted.append(job)
+        self.jobs.put(job)
+
+    def finished(self):
+        ''' The job the pipe signalled done '''
+        job = self.done.get()
+        self.submitted.remove(job)
+        return job
+
+    def run(self):
+        socket = self.ctx.socket(zmq.PAIR)
+        socket.connect(self.address)
+        try:
+            self.server = Server(self.reader, cardservice=self.cardservice,
+                                 **self.serverArgs)
+        except Exception as e:
+            logging.warning("No card served from %s: %s", self.reader, e)
+        socket.send(STARTED)
+        if self.server is None:
+            return
+        # Whichever card is in the reader at the time
+        transmit = lambda apdu: self.server.card.transmit(apdu)
+        # Path the card has selected, None when not known
+        selected = None
+        while True:
+            job = self.jobs.get()
+            try:
+                if job.restore is not None and job.before != selected:
+                    # Left elsewhere by a job run out of order
+                    logging.debug("Selecting %s again", job.before)
+                    for apdu in job.restore:
+                        self.server.card.send(apdu)
+                job.response = job.run(transmit)
+                # A SELECT that failed leaves the card where it was, not
+                # where the cache expected
+                if job.apdus and job.apdus[-1][1:2] == [INS_SELECT] and not isSuccess(job.response):
+                    job.lost = True
+                else:
+                    selected = job.after
+            except Exception as e:
+                job.lost = True
+                logging.error("Card in %s failed: %s", self.reader, e)
+                # Technical problem, no precise diagnosis
+                job.response = [0x6F, 0x00]
+                if isinstance(e, NoCardException):
+                    job.status = STATUS_CARD_REMOVED
+                elif isinstance(e, CardConnectionException):
+                    job.status = STATUS_CARD_NOT_ACCESSIBLE
+            if job.lost:
+                selected = None
+                self.jobs.selectionLost()
+            self.done.put(job)
+            socket.send(b'')
+
+class SimFarm():
+    ''' ROUTER front-end serving every card found in the attached readers.
+    A client asking for an ICCID (in the transport header) goes to that
+    card, any other client is pinned by its identity to the least busy
+    card.
+
+    Everything but talking to the cards happens on the front-end's poll
+    loop: sessions, the protocol and the caches. Whatever can be answered
+    without the card (connecting, the ATR, cached files) is answered
+    straight away, even while a card is busy with another client's
+    command.
+
+    cardservices optionally maps readers to already connected card
+    services, e.g. simulated cards for benchmarking.
+
+    The cards are connected to in the background, so the front-end serves
+    as soon as it is created: heartbeats are answered straight away, other
+    requests wait until every reader found at start has its card (or was
+    found empty), and are then handled in the order they came in.
+
+    With monitor, cards are followed as they are taken out and put in, and
+    readers as they are plugged in: a card swapped in a reader is served
+    within seconds, and its clients are told with a STATUS_IND. An empty
+    reader is then not waited on at start, its card comes as an insertion.
+
+    With keys, the KeyStore the front-end authenticates clients with, each
+    request is checked against its client's entry: a client whose key was
+    revoked is refused, even on a connection made before, and one limited
+    to some SIMs is only served by those cards. '''
+    def __init__(self, ctx, frontend, readers, maxSessions=64, idleTimeout=3600, cache=True,
+                 cardservices=None, trace=None, monitor=False, keys=None):
+        self.ctx = ctx
+        self.frontend = frontend
+        self.keys = keys
+        # Answered to heartbeats, so clients can tell that the server was
+        # restarted and that they have to connect again
+        self.epoch = os.urandom(transport.EPOCH_SIZE)
+        self.serverArgs = dict(maxSessions=maxSessions, idleTimeout=idleTimeout, cache=cache,
+                               trace=trace)
+        if monitor:
+            self.serverArgs['cardTimeout'] = 0
+        self.poller = zmq.Poller()
+        self.poller.register(self.frontend, zmq.POLLIN)
+        # Workers serving a card, by reader for the card events, and by pipe
+        # from the start
+        self.workers = []
+        self.readers = {}
+        self.pipes = {}
+        self.cards = {}
+        self.routes = SessionTable(maxSessions, idleTimeout, self.forget)
+        # Clients that send a header, and so understand pushes
+        self.pushable = set()
+        self.rsap = RSAPMessageProtocol()
+        # Workers found at start and still connecting to their card, and
+        # the requests waiting for them
+        self.starting = set()
+        self.early = []
+        self.workersStarted = 0
+        cardservices = cardservices or {}
+        for reader in readers:
+            self.starting.add(self.startWorker(reader, self.serverArgs, cardservices.get(reader)))
+        self.monitor = None
+        if monitor:
+            self.events = ctx.socket(zmq.PULL)
+            self.events.bind('inproc://card-events')
+            self.poller.register(self.events, zmq.POLLIN)
+            self.monitor = cardmonitor.Monitor(ctx, 'inproc://card-events')
+            self.monitor.start()
+        if not self.starting:
+            self.allStarted()
+
+    def startWorker(self, reader, serverArgs, cardservice=None):
+        worker = CardWorker(self.ctx, reader, self.workersStarted, serverArgs, cardservice)
+        self.workersStarted += 1
+        self.readers[str(reader)] = worker
+        self.pipes[worker.pipe] = worker
+        self.poller.register(worker.pipe, zmq.POLLIN)
+        worker.start()
+        return worker
+
+    def started(self, worker):
+        ''' worker has connected to its card, or found its reader empty '''
+        if worker.server is None:
+            del self.readers[str(worker.reader)]
+            del self.pipes[worker.pipe]
+            self.poller.unregister(worker.pipe)
+            worker.pipe.close()
+        else:
+            self.workers.append(worker)
+            QUEUED.labels(worker.server.reader).setFunction(lambda: len(worker.submitted))
+            if worker.server.iccid:
+                self.cards[worker.server.iccid] = worker
+                logging.info("Serving SIM %s from %s", worker.server.iccid, worker.reader)
+            # The card came or went while it was connected to
+            if worker.pending is not None:
+                self.cardEvent(worker, worker.pending)
+                worker.pending = None
+        if worker in self.starting:
+            self.starting.discard(worker)
+            if not self.starting:
+                self.allStarted()
+
+    def allStarted(self):
+        if not self.cards:
+            logging.warning("No cards found in any reader, waiting for one")
+        early, self.early = self.early, []
+        for envelope, message, client in early:
+            self.request(envelope, message, client)
+
+    def route(self, identity, iccid, client=None):
+        current = self.routes.lookup(identity)
+        allows = client.allows if client is not None else lambda iccid: True
+        if iccid is not None:
+            worker = self.cards.get(iccid) if allows(iccid) else None
+        elif current is not None and allows(current.server.iccid):
+            return current
+        else:
+            workers = [w for w in self.workers if allows(w.server.iccid)]
+            if not workers:
+                return None
+            # An empty reader only if all are, its client hears of the card
+            # once there is one
+            worker = min(workers, key=lambda w: (not w.server.present, w.clients))
+        if worker is not None and worker is not current:
+            if current is not None:
+                current.clients -= 1
+            worker.clients += 1
+            self.routes.insert(identity, worker)
+        return worker
+
+    def forget(self, identity, worker):
+        worker.clients -= 1
+        self.pushable.discard(identity)
+
+    def push(self, worker, message):
+        ''' Send message, unasked, to every client served by worker, or by
+        any card if worker is None '''
+        frames = transport.encodePush(message)
+        for identity, routed in self.routes.items():
+            if identity in self.pushable and (worker is None or routed is worker):
+                self.frontend.send_multipart([identity, b''] + frames)
+
+    def fromWorker(self, worker):
+        if worker.pipe.recv() == STARTED:
+            self.started(worker)
+        else:
+            self.finished(worker)
+
+    def finished(self, worker):
+        job = worker.finished()
+        if job.reply is not None:
+            job.reply.fill(job)
+        else:
+            job.finish(job.response)
+        if job.lost:
+            # The jobs queued after it expect a selection the card does not
+            # have, and so would the next ones
+            worker.server.cardPath = None
+            worker.jobs.selectionFound()
+        # Tell the clients when their card goes away, or comes back
+        if job.status is not None and job.status != worker.status:
+            worker.status = job.status
+            self.push(worker, self.rsap.generateSTATUS_IND(job.status))
+        elif job.status is None and worker.status == STATUS_CARD_NOT_ACCESSIBLE:
+            worker.status = None
+            self.push(worker, self.rsap.generateSTATUS_IND(STATUS_CARD_RECOVERED))
+
+    def onCardEvent(self):
+        event, reader = self.events.recv_multipart()
+        worker = self.readers.get(reader)
+        if worker is None:
+            if event == cardmonitor.ATTACHED:
+                self.attach(reader)
+        elif worker not in self.workers:
+            # Looked at once the worker has started
+            worker.pending = event
+        else:
+            self.cardEvent(worker, event)
+
+    def cardEvent(self, worker, event):
+        if event in (cardmonitor.REMOVED, cardmonitor.DETACHED):
+            self.cardRemoved(worker)
+        elif event == cardmonitor.INSERTED:
+            self.cardInserted(worker)
+
+    def attach(self, reader):
+        ''' Serve a reader plugged in while running. A card already in it is
+        connected to in the background, else it comes as an insertion. '''
+        logging.info("Reader %s attached", reader)
+        self.startWorker(reader, dict(self.serverArgs, cardTimeout=0))
+
+    def cardRemoved(self, worker):
+        server = worker.server
+        if not server.present:
+            return
+        logging.warning("Card %s taken out of %s", server.iccid, server.reader)
+        server.cardRemoved()
+        if self.cards.get(server.iccid) is worker:
+            del self.cards[server.iccid]
+        if worker.status != STATUS_CARD_REMOVED:
+            worker.status = STATUS_CARD_REMOVED
+            self.push(worker, self.rsap.generateSTATUS_IND(STATUS_CARD_REMOVED))
+
+    def cardInserted(self, worker):
+        ''' Connect to the new card on the card's thread, then take it into
+        use. A card that is already in use (told about again when the
+        monitor starts) is left alone. '''
+        server = worker.server
+        if server.present:
+            return
+        worker.submit(CardControl(lambda: server.insertCard(worker.reader),
+                                  lambda done: self.connected(worker, done)))
+
+    def connected(self, worker, done):
+        server = worker.server
+        if done is not True:
+            logging.warning("No card to connect to in %s", server.reader)
+            return
+        server.cardInserted()
+        if server.iccid:
+            self.cards[server.iccid] = worker
+        worker.status = None
+        self.push(worker, self.rsap.generateSTATUS_IND(STATUS_CARD_INSERTED))
+
+    def shutdown(self):
+        ''' Tell every client that the server is going away '''
+        if self.monitor is not None:
+            self.monitor.stop()
+        self.push(None, self.rsap.generateDISCONNECT_IND())
+        self.frontend.close(linger=1000)
+
+    def reject(self, envelope, frames):
+        _, seq, binary = transport.decode(frames)
+        error = buildMessage(messageName['ERROR_RESP'], [])
+        self.frontend.send_multipart(envelope + transport.encode(error, seq, binary))
+
+    def pong(self, envelope, frames):
+        _, seq, _ = transport.decode(frames)
+        worker = self.routes.lookup(envelope[0])
+        card = worker.server.iccid if worker is not None else None
+        self.frontend.send_multipart(envelope + transport.encodePong(seq, self.epoch, card,
+                                                                     sorted(self.cards)))
+
+    def dispatch(self, worker, envelope, frames):
+        start = time.time()
+        server = worker.server
+        if transport.isBatch(frames):
+            fragments, seq = transport.decodeBatch(frames)
+            encode = lambda responses: transport.encodeBatch(responses, seq)
+        else:
+            fragment, seq, binary = transport.decode(frames)
+            fragments = [fragment]
+            encode = lambda responses: transport.encode(responses[0], seq, binary)
+
+        def send(responses):
+            for response in responses:
+                server.answered(response, start, envelope[0])
+            self.frontend.send_multipart(envelope + encode(responses))
+        # A batch's fragments are handled in order, and their CardJobs
+        # queued in that order, before anything else comes in
+        handled = [server.handle(fragment, envelope[0]) for fragment in fragments]
+        Reply(handled, send)
+        for parts in handled:
+            for part in parts:
+                if isinstance(part, CardJob):
+                    part.session = envelope[0]
+                    worker.submit(part)
+
+    def housekeeping(self):
+        ''' Drop idle clients, even when nothing else comes in '''
+        self.routes.expire()
+        for worker in self.workers:
+            worker.server.sessions.expire()
+
+    def receive(self):
+        ''' Returns (envelope, message, client) for the next request, client
+        being the KeyStore's entry for the key it was sent with, if keys are
+        checked '''
+        if self.keys is None:
+            return splitEnvelope(self.frontend.recv_multipart()) + (None,)
+        frames = self.frontend.recv_multipart(copy=False)
+        # The authenticator made the client's public key the User-Id
+        client = self.keys.lookup(frames[-1].get('User-Id'))
+        return splitEnvelope([frame.bytes for frame in frames]) + (client,)
+
+    def request(self, envelope, message, client=None):
+        try:
+            if self.keys is not None and client is None:
+                logging.warning("Refusing request from %r, its key was revoked", envelope[0])
+                self.reject(envelope, message)
+                return
+            if transport.isPing(message):
+                self.pong(envelope, message)
+                return
+            if self.starting:
+                self.early.append((envelope, message, client))
+                return
+            worker = self.route(envelope[0], transport.requestedCard(message), client)
+            if len(message) >= 2:
+                self.pushable.add(envelope[0])
+            if worker is None:
+                logging.warning("No card for request from %s",
+                                client.name if client is not None else repr(envelope[0]))
+                self.reject(envelope, message)
+            else:
+                self.dispatch(worker, envelope, message)
+        except ValueError as e:
+            logging.warning("Dropping bad request from %r: %s", envelope[0], e)
+        except Exception:
+            # One client's request must not take the others' down with it
+            logging.exception("Failed to handle request from %r", envelope[0])
+            try:
+                self.reject(envelope, message)
+            except Exception:
+                pass
+
+    def run(self):
+        while True:
+            events = self.poller.poll(HOUSEKEEPING_INTERVAL * 1000)
+            if not events:
+                self.housekeeping()
+            for socket, event in events:
+                if socket is self.frontend:
+                    self.request(*self.receive())
+                elif self.monitor is not None and socket is self.events:
+                    self.onCardEvent()
+                else:
+                    self.fromWorker(self.pipes[socket])
+
+def bindFrontend(ctx, address='tcp://*:9000', base_dir=None, keys=None):
+    ''' ROUTER socket bound to address, only accepting clients whose
+    public key is in base_dir/public_keys, or in the KeyStore keys. Returns
+    (socket, authenticator). '''
 
     # These direcotries are generated by the generate_certificates script
-    base_dir = os.path.dirname(__file__)
+    if base_dir is None:
+        base_dir = os.path.dirname(__file__)
     keys_dir = os.path.join(base_dir, 'certificates')
     public_keys_dir = os.path.join(base_dir, 'public_keys')
     secret_keys_dir = os.path.join(base_dir, 'private_keys')
@@ -291,32 +849,48 @@ def run():
         logging.critical("Certificates are missing - run generate_certificates.py script first")
         sys.exit(1)
 
-    ctx = zmq.Context().instance()
-
     # Start an authenticator for this context.
     auth = ThreadAuthenticator(ctx)
     auth.start()
     # auth.allow('127.0.0.1')
-    # Tell authenticator to use the certificate in a directory
-    auth.configure_curve(domain='*', location=public_keys_dir)
+    if keys is not None and hasattr(auth, 'configure_curve_callback'):
+        # Looked up in the store, which follows the directory
+        auth.configure_curve_callback(domain='*', credentials_provider=keys)
+    else:
+        # Tell authenticator to use the certificate in a directory
+        auth.configure_curve(domain='*', location=public_keys_dir)
 
-    server = ctx.socket(zmq.REP)
+    server = ctx.socket(zmq.ROUTER)
 
     server_secret_file = os.path.join(secret_keys_dir, "server.key_secret")
     server_public, server_secret = zmq.auth.load_certificate(server_secret_file)
     server.curve_secretkey = server_secret
     server.curve_publickey = server_public
     server.curve_server = True  # must come before bind
-    server.bind('tcp://*:9000')
-
-    RSAPServer = Server()
-
-    while True:
-        print("recv")
-        message = server.recv_json()
-        print("Received request: %s" % message)
-        result = RSAPServer.process(message)
-        server.send_json(result)
+    # A client reconnecting under its identity takes over at once, even
+    # before its old connection is known to be dead
+    if hasattr(zmq, 'ROUTER_HANDOVER'):
+        server.setsockopt(zmq.ROUTER_HANDOVER, 1)
+    server.bind(address)
+    return server, auth
+
+def run(args, trace=None, endpoint=None):
+    ''' Run secure server '''
+    ctx = zmq.Context().instance()
+    keys = KeyStore(os.path.join(os.path.dirname(__file__), 'public_keys'))
+    server, auth = bindFrontend(ctx, keys=keys)
+
+    # Serving from here on, the cards are connected to in the background
+    farm = SimFarm(ctx, server, listReaders(), args.max_sessions, args.idle_timeout,
+                   cache=not args.no_cache, trace=trace, monitor=True, keys=keys)
+    readiness.ready("Listening, connecting to the cards")
+    if endpoint is not None:
+        endpoint.start()
+    try:
+        farm.run()
+    except KeyboardInterrupt:
+        logging.info("Stopping")
+        farm.shutdown()
 
     # stop auth thread
     auth.stop()
@@ -325,10 +899,15 @@ if __name__ == '__main__':
     if zmq.zmq_version_info() < (4,0):
         raise RuntimeError("Security is not supported in libzmq version < 4.0. libzmq version {0}".format(zmq.zmq_version()))
 
-    if '-v' in sys.argv:
-        level = logging.DEBUG
-    else:
-        level = logging.INFO
-    logging.basicConfig(level=level, format="[%(levelname)s] %(message)s")
-
-    run()
+    parser = argparse.ArgumentParser(description="Serve the attached SIM cards to remote modems")
+    parser.add_argument('--max-sessions', type=int, default=64,
+                        help="clients remembered per card before the least recently used is dropped")
+    parser.add_argument('--idle-timeout', type=float, default=3600,
+                        help="seconds after which an idle client's session is dropped")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="send every APDU to the card, even reads of static files")
+    tracing.addArguments(parser)
+    metrics.addArguments(parser)
+    args = parser.parse_args()
+
+    run(args, tracing.configure(args), metrics.configure(args))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""
+Logging set-up shared by the server, the relay and the D-Bus service, and an
+optional binary trace of the RSAP traffic.
+
+Nothing on the path of an APDU formats anything unless its level is enabled:
+hex dumps and decoded messages are handed to logging as rsap.HexDump and
+rsap.MessageDump objects, which are only turned into text when a record is
+actually emitted. The levels are
+
+    -v              DEBUG: every fragment and message, decoded, and the
+                    APDUs exchanged with the card
+    (default)       INFO: connections, resets, cards found
+    --production    WARNING: nothing per APDU at all
+
+The trace (--trace FILE) records the raw bytes of every fragment received and
+every reply sent. The file starts with the magic 'RSAPTRC' and a version
+byte, then each record has a fixed size header:
+
+    | 8 (double) | 1         | 1    | 2        | 4 (unsigned) | 4 (unsigned) |  length  |
+      timestamp    direction   type   reserved   session        length          bytes
+
+with all numbers in network byte order. type is the ID of the first RSAP
+message in the bytes (0xFF if there are none), session a CRC-32 of the
+client's key (ZMQ identity or D-Bus sender, see sessionID()), 0 if unknown.
+
+With --trace-size the file is rotated like a log: once it would grow past
+the size, it is renamed to FILE.1 (FILE.1 to FILE.2, and so on, keeping
+--trace-keep of them) and a new FILE started.
+
+TraceReader maps a trace into memory and indexes where each record starts,
+so a long trace can be filtered by session, message type or direction
+without reading it in, as can be done from the command line:
+
+    python tracing.py FILE [--session ID] [--type NAME] [--direction in|out]
+"""
+
+import os
+import sys
+import time
+import mmap
+import zlib
+import struct
+import logging
+import argparse
+import threading
+from array import array
+from collections import namedtuple
+
+FILE_HEADER = struct.Struct('!7sB')
+MAGIC = 'RSAPTRC'
+VERSION = 2
+RECORD = struct.Struct('!dBBxxII')
+
+IN = 0
+OUT = 1
+
+# Message type of a record holding no complete message ID
+NO_MESSAGE = 0xFF
+
+Record = namedtuple('Record', 'timestamp direction session type data')
+
+
+def sessionID(key):
+    ''' Session number recorded for a client key, 0 for None '''
+    if key is None:
+        return 0
+    return zlib.crc32(str(key)) & 0xFFFFFFFF
+
+
+def messageType(data):
+    return bytearray(data[:1])[0] if len(data) else NO_MESSAGE
+
+
+class TraceSink:
+    ''' Appends records to a binary trace file, rotating it once it reaches
+    maxBytes (never if None), with the last keep files kept. Safe to share
+    between threads. '''
+    def __init__(self, path, maxBytes=None, keep=5):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+            # A reader can open the file straight away
+            self.file.flush()
+            self.size = FILE_HEADER.size
+        elif not isTrace(self.path):
+            # Not ours to append to, e.g. an older format
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        for index in xrange(self.keep - 1, 0, -1):
+            older = '%s.%d' % (self.path, index)
+            if os.path.exists(older):
+                os.rename(older, '%s.%d' % (self.path, index + 1))
+        if self.keep:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def record(self, direction, data, session=None):
+        header = RECORD.pack(time.time(), direction, messageType(data), sessionID(session),
+                             len(data))
+        length = len(header) + len(data)
+        with self.lock:
+            if self.maxBytes and self.size > FILE_HEADER.size and \
+                    self.size + length > self.maxBytes:
+                self.rotate()
+            self.file.write(header)
+            self.file.write(data)
+            self.size += length
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def isTrace(path):
+    with open(path, 'rb') as f:
+        header = f.read(FILE_HEADER.size)
+    return len(header) == FILE_HEADER.size and FILE_HEADER.unpack(header) == (MAGIC, VERSION)
+
+
+class TraceReader:
+    ''' A trace file mapped into memory. Opening it reads the record headers
+    only, into an index of where each record starts and of its session and
+    message type; the bytes of a record are only read when it is looked at.
+    A record still being written at the end of the file is left out. '''
+    def __init__(self, path):
+        if not isTrace(path):
+            raise ValueError('%s is not an RSAP trace' % path)
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        self.offsets = array('L')
+        self.sessions = array('I')
+        self.types = array('B')
+        self.directions = array('B')
+        pos = FILE_HEADER.size
+        while pos + RECORD.size <= size:
+            _, direction, type, session, length = RECORD.unpack_from(self.map, pos)
+            if pos + RECORD.size + length > size:
+                break
+            self.offsets.append(pos)
+            self.sessions.append(session)
+            self.types.append(type)
+            self.directions.append(direction)
+            pos += RECORD.size + length
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        pos = self.offsets[index]
+        timestamp, direction, type, session, length = RECORD.unpack_from(self.map, pos)
+        start = pos + RECORD.size
+        return Record(timestamp, direction, session, type, self.map[start:start+length])
+
+    def select(self, session=None, type=None, direction=None):
+        ''' Indices of the records matching every filter given '''
+        for index in xrange(len(self.offsets)):
+            if session is not None and self.sessions[index] != session:
+                continue
+            if type is not None and self.types[index] != type:
+                continue
+            if direction is not None and self.directions[index] != direction:
+                continue
+            yield index
+
+    def records(self, session=None, type=None, direction=None):
+        for index in self.select(session, type, direction):
+            yield self[index]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def readTrace(path):
+    ''' Yields (timestamp, direction, data) for every record in a trace '''
+    reader = TraceReader(path)
+    try:
+        for record in reader.records():
+            yield record.timestamp, record.direction, record.data
+    finally:
+        reader.close()
+
+
+def addArguments(parser):
+    parser.add_argument('-v', action='store_true',
+                        help="debug logging: every message, decoded, and the card's APDUs")
+    parser.add_argument('--production', action='store_true',
+                        help="only log warnings and errors")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="append the raw RSAP traffic to FILE")
+    parser.add_argument('--trace-size', type=float, metavar='MB',
+                        help="start a new trace file once FILE reaches MB megabytes")
+    parser.add_argument('--trace-keep', type=int, default=5, metavar='N',
+                        help="trace files kept besides FILE when rotating (default 5)")
+
+
+def configure(args):
+    ''' Set up logging from the parsed arguments. Returns the TraceSink to
+    record traffic to, or None. '''
+    if args.v:
+        level = logging.DEBUG
+    elif args.production:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+    logging.basicConfig(level=level, format="[%(levelname)s] %(message)s")
+    if args.trace:
+        maxBytes = int(args.trace_size * 1024 * 1024) if args.trace_size else None
+        return TraceSink(args.trace, maxBytes, args.trace_keep)
+    return None
+
+
+def debugging():
+    ''' Whether per APDU debug output is wanted at all, e.g. to decide on
+    attaching a card connection observer '''
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+if __name__ == '__main__':
+    from rsap import messageID, messageName, hexString
+
+    parser = argparse.ArgumentParser(description="Print the records of an RSAP trace")
+    parser.add_argument('trace', metavar='FILE')
+    parser.add_argument('--session', type=lambda value: int(value, 16),
+                        help="only this session, as printed (hex)")
+    parser.add_argument('--type', choices=sorted(messageName),
+                        help="only records starting with this message")
+    parser.add_argument('--direction', choices=('in', 'out'),
+                        help="only what the server or relay received, or sent")
+    args = parser.parse_args()
+
+    reader = TraceReader(args.trace)
+    records = reader.records(args.session,
+                             messageName[args.type] if args.type else None,
+                             {'in': IN, 'out': OUT}.get(args.direction))
+    try:
+        for record in records:
+            print '%.6f %s %08x %-32s %s' % (record.timestamp, '<>'[record.direction],
+                                             record.session,
+                                             messageID.get(record.type, '-'),
+                                             hexString(record.data))
+    except IOError:
+        # Piped into head
+        sys.exit(0)
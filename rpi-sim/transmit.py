@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Sending APDUs to a card with the transport level status word chains
+resolved next to it, so one RSAP round trip always returns the final data:
+
+    61xx    xx more bytes available: GET RESPONSE, repeated while the card
+            keeps answering 61xx, with the data of each part concatenated
+    9Fxx    the same for GSM SIMs
+    6Cxx    wrong Le, exactly xx bytes available: the command (or the
+            GET RESPONSE) is sent again with Le = xx
+
+A client that does not know this still sends its own GET RESPONSE after a
+command. That is answered from the data just fetched, as the card itself
+would have.
+
+A READ BINARY with an extended Le (up to 64 KiB, or all of it for 0000) is
+answered in one response, whether the card takes extended APDUs or not: it
+is sent to the card as short READ BINARYs of 256 bytes at successive
+offsets, until Le bytes or the end of the file. Reading a large transparent
+EF then takes one RSAP round trip instead of one per 256 bytes.
+"""
+
+import time
+
+from smartcard.scard import SCARD_RESET_CARD
+
+import metrics
+from apducache import INS_READ_BINARY, isExtended, responseLength
+
+INS_GET_RESPONSE = 0xC0
+
+# Data a short READ BINARY returns at most, and the highest offset it takes
+SHORT_READ = 0x100
+MAX_OFFSET = 0x7FFF
+
+# Bound on the number of continuations for one command, in case a card
+# never stops asking for another GET RESPONSE
+MAX_CHAIN = 32
+
+CARD_TRANSMIT = metrics.histogram('rsap_card_transmit_seconds',
+                                  "Time the card takes to answer one command, by reader",
+                                  ('reader',))
+
+
+def getResponse(cla, length):
+    return [cla, INS_GET_RESPONSE, 0x00, 0x00, length]
+
+
+class TransmitEngine:
+    ''' transmit(apdu) on a pyscard connection, returning the response data
+    followed by SW1 SW2 as a list '''
+    def __init__(self, connection, reader=''):
+        self.connection = connection
+        self.latency = CARD_TRANSMIT.labels(reader)
+        # Data fetched by the last resolved chain, for a client that
+        # follows up with a GET RESPONSE of its own
+        self.fetched = None
+
+    def powerOff(self):
+        ''' Unpower the card, leaving the reader idle '''
+        self.fetched = None
+        self.connection.disconnect()
+
+    def powerOn(self):
+        self.connection.connect()
+
+    def reset(self):
+        ''' Warm reset where the connection can do one, else power the card
+        off and on again '''
+        self.fetched = None
+        reconnect = getattr(self.connection, 'reconnect', None)
+        if reconnect is not None:
+            reconnect(disposition=SCARD_RESET_CARD)
+        else:
+            self.connection.disconnect()
+            self.connection.connect()
+
+    def send(self, apdu):
+        start = time.time()
+        resp, sw1, sw2 = self.connection.transmit(apdu)
+        self.latency.observe(time.time() - start)
+        return list(resp), sw1, sw2
+
+    def transmit(self, apdu):
+        apdu = list(bytearray(apdu))
+        if len(apdu) >= 4 and apdu[1] == INS_GET_RESPONSE and self.fetched is not None:
+            return self.replayResponse(apdu)
+        self.fetched = None
+        if len(apdu) == 7 and apdu[1] == INS_READ_BINARY and isExtended(apdu):
+            return self.readBinary(apdu)
+        command = apdu
+        data = []
+        fetched = False
+        part, sw1, sw2 = self.send(command)
+        for i in xrange(MAX_CHAIN):
+            if sw1 == 0x6C and len(command) == 5:
+                command = command[:4] + [sw2]
+            elif sw1 in (0x61, 0x9F):
+                data += part
+                command = getResponse(apdu[0], sw2)
+                fetched = True
+            else:
+                break
+            part, sw1, sw2 = self.send(command)
+        data += part
+        if fetched and sw1 == 0x90:
+            self.fetched = data
+        return data + [sw1, sw2]
+
+    def readBinary(self, apdu):
+        ''' Extended READ BINARY as short ones, each resolved by transmit() '''
+        cla, p1, p2 = apdu[0], apdu[2], apdu[3]
+        le = responseLength(apdu)
+        if p1 & 0x80:
+            # Short file identifier: the first read selects the file, the
+            # offset is in P2
+            offset = p2
+        else:
+            offset = (p1 << 8) | p2
+        data = []
+        while len(data) < le and offset <= MAX_OFFSET:
+            length = min(SHORT_READ, le - len(data))
+            response = self.transmit([cla, INS_READ_BINARY, p1, p2, length & 0xFF])
+            part, sw = response[:-2], response[-2:]
+            if sw == [0x62, 0x82]:
+                # End of file reached before the bytes asked for
+                data += part
+                break
+            if sw != [0x90, 0x00]:
+                if not data:
+                    return response
+                # 6B00, offset past the end of a file that ended on a read
+                break
+            data += part
+            offset += len(part)
+            if len(part) < length:
+                break
+            p1, p2 = offset >> 8, offset & 0xFF
+        # Le 0000 asks for as much as there is
+        if len(data) < le and le != 0x10000:
+            return data + [0x62, 0x82]
+        return data + [0x90, 0x00]
+
+    def replayResponse(self, apdu):
+        data, self.fetched = self.fetched, None
+        le = apdu[4] if len(apdu) > 4 else 0
+        if le > len(data):
+            # Wrong length, as the card would say
+            self.fetched = data
+            return [0x6C, len(data) & 0xFF]
+        return (data[:le] if le else data) + [0x90, 0x00]
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+Framing of RSAP messages on the ZMQ link between the relay and the SIM server.
+
+Binary mode sends the RSAP bytes as they are, optionally preceded by a small
+header frame carrying a sequence number:
+
+    [payload]             raw RSAP bytes
+    [header, payload]     header = magic 'RS', version, flags, sequence number,
+                          optionally followed by the ICCID of the SIM the
+                          client wants to be served by
+
+A batch carries several RSAP messages in one request, flagged in the header
+and with one payload frame per message:
+
+    [header, payload, payload, ...]
+
+The server runs them in order and answers with a batch holding the replies,
+one frame each, under the same sequence number. Only clients that were told
+to (the relay's --batch) send batches, as older servers do not know them.
+
+A heartbeat is a header flagged as a ping and an empty payload. The server
+answers it straight away, without involving a card, with a ping whose
+payload is a token that changes whenever the server is restarted (its
+epoch), followed by JSON naming the card that serves the client, if any,
+and every card the server has: {"card": ICCID, "cards": [ICCID, ...]}.
+
+The server may also send a client messages it did not ask for, e.g. a
+STATUS_IND when its card stops answering, as a header flagged as a push,
+with sequence number 0, and the RSAP message:
+
+    [header, payload]
+
+Only the binary encoding with a header carries pushes, so they never reach
+a JSON client.
+
+The original JSON encoding (one frame holding a list of byte values) is still
+understood. The server answers every request in the framing it arrived in, so
+the mode is effectively chosen per connection by the client. A JSON frame
+always starts with '[' (0x5B), which is never a valid RSAP message ID.
+"""
+
+import json
+import struct
+
+HEADER = struct.Struct('!2sBBI')
+MAGIC = 'RS'
+VERSION = 1
+
+JSON_START = ord('[')
+
+# Header flags
+FLAG_BATCH = 0x01
+FLAG_PING = 0x02
+FLAG_PUSH = 0x04
+
+EPOCH_SIZE = 8
+
+
+def packHeader(seq, flags=0, iccid=None):
+    header = HEADER.pack(MAGIC, VERSION, flags, seq & 0xFFFFFFFF)
+    if iccid:
+        header += iccid
+    return header
+
+
+def unpackHeader(frame):
+    ''' Returns (flags, seq) from a header frame '''
+    if len(frame) < HEADER.size:
+        raise ValueError('Bad header frame length %d' % len(frame))
+    magic, version, flags, seq = HEADER.unpack_from(frame)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unknown header %r version %d' % (magic, version))
+    return flags, seq
+
+
+def requestedCard(frames):
+    ''' ICCID the client asked for in its header frame, or None '''
+    if len(frames) >= 2 and len(frames[0]) > HEADER.size:
+        return bytes(frames[0][HEADER.size:])
+    return None
+
+
+def encode(payload, seq=None, binary=True, flags=0, iccid=None):
+    ''' Frames to send for one RSAP payload '''
+    if not binary:
+        return [json.dumps(list(bytearray(payload)))]
+    if seq is None and not iccid:
+        return [bytes(payload)]
+    return [packHeader(seq or 0, flags, iccid), bytes(payload)]
+
+
+def encodeBatch(payloads, seq, iccid=None):
+    ''' Frames to send for several RSAP payloads at once '''
+    return [packHeader(seq, FLAG_BATCH, iccid)] + [bytes(payload) for payload in payloads]
+
+
+def isBatch(frames):
+    return len(frames) >= 2 and bool(unpackHeader(frames[0])[0] & FLAG_BATCH)
+
+
+def decodeBatch(frames):
+    ''' Returns (payloads, seq) for received batch frames '''
+    flags, seq = unpackHeader(frames[0])
+    return frames[1:], seq
+
+
+def encodePing(seq, payload=b''):
+    ''' Heartbeat request, or the answer to one with payload '''
+    return [packHeader(seq, FLAG_PING), bytes(payload)]
+
+
+def encodePong(seq, epoch, card=None, cards=()):
+    ''' Answer to a heartbeat '''
+    return encodePing(seq, epoch + json.dumps({'card': card, 'cards': list(cards)}))
+
+
+def decodePong(payload):
+    ''' Returns (epoch, card, cards) from the payload of a heartbeat's
+    answer. Older servers only send the epoch, or nothing. '''
+    epoch, info = bytes(payload[:EPOCH_SIZE]), bytes(payload[EPOCH_SIZE:])
+    try:
+        info = json.loads(info) if info else {}
+    except ValueError:
+        info = {}
+    card = info.get('card')
+    return epoch, str(card) if card else None, [str(c) for c in info.get('cards', [])]
+
+
+def isPing(frames):
+    return len(frames) == 2 and bool(unpackHeader(frames[0])[0] & FLAG_PING)
+
+
+def encodePush(payload):
+    ''' Frames for a message the client did not ask for '''
+    return [packHeader(0, FLAG_PUSH), bytes(payload)]
+
+
+def isPush(frames):
+    return len(frames) == 2 and bool(unpackHeader(frames[0])[0] & FLAG_PUSH)
+
+
+def decode(frames):
+    ''' Returns (payload, seq, binary) for received frames. seq is None
+    when the peer did not send a header. '''
+    if len(frames) == 2:
+        flags, seq = unpackHeader(frames[0])
+        return frames[1], seq, True
+    if len(frames) != 1:
+        raise ValueError('Unexpected number of frames: %d' % len(frames))
+    frame = frames[0]
+    if len(frame) and bytearray(frame[:1])[0] == JSON_START:
+        return bytes(bytearray(json.loads(frame))), None, False
+    return frame, None, True